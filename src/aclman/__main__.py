@@ -4,13 +4,10 @@ import datetime
 import logging
 import os, sys
 import subprocess
-import csv, json
+import csv
 import re
 
 import socket
-import urllib.request
-import urllib.parse
-import importlib.resources
 import importlib.metadata
 import pathlib
 
@@ -24,8 +21,13 @@ from .api import grouper as Grouper
 from .api import mrbs as Mrbs
 from .api import skylab as Skylab
 from .api import zoho as Zoho
+from .api import transport
 
 from . import config_handler
+from . import concurrency
+from . import cache
+from . import snapshot
+from . import section_file
 
 
 def andrewid_str(andrewId):
@@ -37,6 +39,9 @@ cli = CliParser('ACLMAN', "python -m aclman")
 cli.option('-s', '--sectionfile', dest='sectionfile', metavar='FILE', action='store', default=None, help="specify a path to a CSV section file defining privileges")
 cli.option('-c', '--configfile', dest='configfile', metavar='FILE', action='store', default="config/config.yaml", help="specify a path to a YAML file defining configuration")
 cli.option('-S', '--secretsfile', dest='secretsfile', metavar='FILE', action='store', default="config/secrets.yaml", help="specify a path to a YAML file defining connection/authentication secrets")
+cli.option('-j', '--jobs', dest='jobs', metavar='N', action='store', type=int, default=None, help="specify the number of concurrent workers for network-bound stages (default: `jobs` from configuration)")
+cli.option('--refresh', dest='refresh', action='store_true', default=False, help="ignore all cached API data (e.g., from S3) and refetch everything, updating the cache")
+cli.option('--incremental', dest='incremental', action='store_true', default=False, help="only reconcile users whose calculated state changed since the last run, unless a full sync is due")
 args = cli.parse()
 
 config_handler.set_config_path(args.configfile)
@@ -44,9 +49,11 @@ config_handler.set_secrets_path(args.secretsfile)
 
 config = config_handler.get_config()
 secrets = config_handler.get_secrets()
-# NOTE: Although each API loads its secrets once it's used, Zoho auth tokens
-# are only valid for an hour, so we separately call Zoho.authenticate() closer
-# to when it's needed.
+concurrency.set_jobs(args.jobs)
+cache.refresh = args.refresh
+# NOTE: Each API loads its secrets once it's used.  Zoho and BioRAFT tokens
+# are only valid for an hour, but are stored and refreshed as needed (see
+# `tokens`).
 
 script_begin_time = helpers.now()
 run_date = script_begin_time.strftime("%Y-%m-%d-%H%M%S")
@@ -64,8 +71,8 @@ else:
     sys.exit(1)
 
 # Install a default instrumented URL opener.
-instrumented_opener = urllib.request.build_opener(helpers.CustomHTTPErrorHandler)
-urllib.request.install_opener(instrumented_opener)
+instrumented_opener = transport.build_opener(helpers.CustomHTTPErrorHandler)
+transport.install_opener(instrumented_opener)
 
 # Configure logging.
 log_dir = pathlib.Path(config['log_dir']).resolve()
@@ -94,77 +101,18 @@ logger.info("ACLMAN script started: %s" % script_begin_time)
 logger.info("ACLMAN verison is: %s" % importlib.metadata.version('aclman'))
 logger.info("Local host is: %s" % socket.getfqdn())
 logger.info("Environment is: %s" % config['environment'])
+logger.info("Concurrent jobs: %d" % concurrency.get_jobs())
 
 
 
-default_section_file_input = config['default_inputs']['section_file']
-
-# Read in and process the list of sections from the section file.
+# Read in and process the list of sections, and the privileges associated with
+# each, from the section file.
 if args.sectionfile is None:
   logger.info("Processing default list of sections from built-in section file....")
-  s = importlib.resources.open_text(default_section_file_input['package'], default_section_file_input['file'])
 else:
   logger.info("Processing requested list of sections from section file `%s`...." % args.sectionfile)
-  section_file_path = pathlib.Path(config_handler.cwd, args.sectionfile).resolve()
-  if not section_file_path.is_file():
-    raise FileNotFoundError("No section file found at '%s'" % section_file_path)
-  s = open(section_file_path, "r")
-sreader = csv.reader(s)
-
-all_sections = []
-all_section_privileges = {}
-for row in sreader:
-  # TODO: Be more robust in how this file is read in.
-  # TODO: Allow for comments/header in the section file.
-  section = Section(row[0], row[1], row[2])
-
-  if section in all_sections:
-    logger.debug("Skipping duplicate section %s" % section)
-  else:
-    # TODO: Verify that the section actually exists by calling
-    # `/course/courses?semester=...&courseNumber=...&section=...`
-    # NOTE: For now, we catch this later when we try to look up its crosslists.
-    all_sections.append(section)
-    # Initialize an empty privileges list for this section.
-    all_section_privileges[section] = []
-    logger.debug("Added section %s" % section)
-
-s.close()
-
-
-# Read in and process the privileges associated with each section from the
-# section file.
-if args.sectionfile is None:
-  logger.info("Processing associated privileges for %d sections from built-in section file...." % len(all_sections))
-  s = importlib.resources.open_text(default_section_file_input['package'], default_section_file_input['file'])
-else:
-  logger.info("Processing associated privileges for %d sections from requested section file `%s`...." % (len(all_sections), args.sectionfile))
-  section_file_path = pathlib.Path(config_handler.cwd, args.sectionfile).resolve()
-  if not section_file_path.is_file():
-    raise FileNotFoundError("No section file found at '%s'" % section_file_path)
-  s = open(section_file_path, "r")
-sreader = csv.reader(s)
-
-all_privilege_types = []
-for row in sreader:
-  # TODO: Be more robust in how this file is read in.
-  # TODO: Allow for comments in the section file.
-  section = Section(row[0], row[1], row[2])
-  privilege_type = PrivilegeType(row[3], row[4])
-  privilege = Privilege(privilege_type, row[5], row[6], [section])
-
-  # First, register the privilege type if it's new.
-  if privilege_type not in all_privilege_types:
-    logger.debug("Identified new privilege type %s" % privilege_type)
-    all_privilege_types.append(privilege_type)
-  # Then, register the specific privilege.
-  if privilege in all_section_privileges[section]:
-    logger.debug("Skipped duplicate privilege for %s: %s" % (section, privilege))
-  else:
-    all_section_privileges[section].append(privilege)
-    logger.debug("Added privilege for %s: %s" % (section, privilege))
-
-s.close()
+(all_sections, all_privilege_types, all_section_privileges) = section_file.load(args.sectionfile)
+logger.info("Found %d sections with %d privilege types" % (len(all_sections), len(all_privilege_types)))
 
 
 # TODO: If `section` is discovered not to exist, mark it as not existing and
@@ -173,10 +121,13 @@ s.close()
 
 # Find all crosslisted sections, and copy the associated privileges where
 # appropriate.
-all_crosslisted_sections = []
+all_crosslisted_sections = {}
 logger.info("Finding crosslists of the specified sections and copying privileges....")
+# Resolve all crosslists up front, concurrently; each crosslist group is only
+# fetched once, however many of its members are listed.
+all_section_crosslists = S3.resolve_crosslists(all_sections)
 for section in all_sections:
-  for crosslist_section in S3.get_crosslists(section):
+  for crosslist_section in all_section_crosslists[section]:
     if crosslist_section in all_sections:
       # If the section already exists, just skip it.  Don't copy the privileges,
       # as others might be explicitly defined, e.g., different privileges for
@@ -184,18 +135,19 @@ for section in all_sections:
       logger.debug("Found %s (crosslist of %s); skipping, already defined" % (crosslist_section, section))
     else:
       logger.debug("Found %s (crosslist of %s); adding new section" % (crosslist_section, section))
-      all_crosslisted_sections.append(crosslist_section)
-      all_section_privileges[crosslist_section] = []
+      all_crosslisted_sections[crosslist_section] = None
+      all_section_privileges[crosslist_section] = {}
       # Copy the privileges associated with the original section.
       for privilege in all_section_privileges[section]:
         new_privilege = privilege.replace_sections([crosslist_section])
-        all_section_privileges[crosslist_section].append(new_privilege)
+        all_section_privileges[crosslist_section][new_privilege] = None
         logger.debug("  Copied privilege: %s" % new_privilege)
 
-# Add all crosslisted sections to the overall list of sections, then free the
-# list of crosslisted sections since we're done with it.
-all_sections.extend(all_crosslisted_sections)
+# Add all crosslisted sections to the overall set of sections, then free the
+# set of crosslisted sections since we're done with it.
+all_sections.update(all_crosslisted_sections)
 del all_crosslisted_sections
+del all_section_crosslists
 
 
 # Load the rosters for all sections and bring each student's enrollment data
@@ -210,8 +162,12 @@ logger.info("Processing rosters for each section....")
 all_bioIds = {}
 enrollments_by_bioId = {}
 
-for section in all_sections:
-  section_roster = S3.get_roster_bioUrls(section)
+# Fetch all rosters concurrently, since this is almost entirely network wait.
+# The results come back in the same order as `all_sections`, so they are
+# merged below exactly as they would have been in a serial run.
+all_section_rosters = concurrency.map_ordered(S3.get_roster_bioUrls, all_sections)
+
+for section, section_roster in zip(all_sections, all_section_rosters):
   enrollment_count = len(section_roster)
   if enrollment_count == 0:
     logger.warning("%-12s: NO STUDENTS ARE ENROLLED!" % section)
@@ -236,13 +192,19 @@ for section in all_sections:
     # `finalGrade` data for each student, but doesn't in practice.
     # TODO: Request explicit API access to such `finalGrade` data.
 
+# Free the list of rosters since we're done with it.
+del all_section_rosters
+
 
 # Get data for each student, and record their sections alongside.
 logger.info("Getting data for all %d dedup'd students found...." % len(all_bioIds))
+# Hydrate all students concurrently, then record them in the same order as a
+# serial run would have.
+hydrated_students = S3.get_students_from_bioids(all_bioIds)
 for bioId in all_bioIds:
   # Keep track of this student's enrolled sections.
   sections = sorted(all_bioIds[bioId]['sections'])
-  student = S3.get_student_from_bioid(bioId)
+  student = hydrated_students[bioId]
 
   if student:
     logger.debug("%-39s\t%s" % (student, ','.join(str(x) for x in sections)))
@@ -252,8 +214,9 @@ for bioId in all_bioIds:
   else:
     logger.error("Did not find data for BIO ID '%s'" % bioId)
 
-# Free the dictionary of BIO IDs since we're done with it.
+# Free the dictionaries of BIO IDs since we're done with them.
 del all_bioIds
+del hydrated_students
 
 
 # Determine section-based privileges for each student found in the rosters.
@@ -354,27 +317,7 @@ for andrewId in sorted(all_student_privileges.keys()):
   coalesced_student_privileges[andrewId] = []
   for privilege_type in all_student_privileges[andrewId]:
     privileges = all_student_privileges[andrewId][privilege_type]
-    try:
-      while len(privileges) > 1:
-        a = privileges.pop()
-        b = privileges.pop()
-        p = a.coalesce(b)
-        privileges.append(p)
-      # Extend the list of coalesced privileges with the resulting
-      # single-element list.
-      coalesced_student_privileges[andrewId].extend(privileges)
-    except ValueError:
-      logger.warning("ValueError when attempting to coalesce privileges %s and %s" % (a, b))
-      # If for some reason we tried to coalesce unlike privileges, just find
-      # any one that is current.
-      for privilege in privileges:
-        if privilege.is_current():
-          coalesced_student_privileges[andrewId].append(privilege)
-          logger.warning("  Used %s as the coalesced representative for %s, because it is current" % (privilege, privilege_type))
-          break
-      # If none are current, take the first.
-      coalesced_student_privileges[andrewId].append(privileges[0])
-      logger.warning("  Used %s as the coalesced representative for %s, since none were current" % (privileges[0], privilege_type))
+    coalesced_student_privileges[andrewId].append(Privilege.coalesce_all(privileges))
 
   for privilege in coalesced_student_privileges[andrewId]:
     logger.debug("  %s" % privilege)
@@ -383,6 +326,73 @@ for andrewId in sorted(all_student_privileges.keys()):
 del all_student_privileges
 
 
+# Determine whether this is a full or an incremental sync.  An incremental sync
+# compares the calculated state of each user against the previous snapshot and
+# only reconciles downstream systems for users whose effective state changed,
+# users whose state isn't tracked by ACLMAN at all (e.g., those granted access
+# only by overrides), and current or former members of override groups.  Since
+# this trusts that the downstream systems are otherwise unchanged, a full sync
+# is still forced periodically, as well as after any run which failed to
+# reconcile every change.
+full_sync = True
+changed_andrewIds = set()
+tracked_andrewIds = set(coalesced_student_privileges.keys())
+full_sync_path = pathlib.Path(config['output_dirs']['jsondata'], "last-full-sync.txt").resolve()
+last_full_sync = snapshot.read_full_sync_time(full_sync_path)
+overrides_path = pathlib.Path(config['output_dirs']['jsondata'], "overrides.json").resolve()
+previous_overrides = snapshot.read_overrides(overrides_path)
+current_overrides = {}
+if args.incremental:
+  previous_snapshot = snapshot.load(pathlib.Path(config['output_dirs']['jsondata'], "latest.json").resolve())
+  full_sync_interval = datetime.timedelta(days=config['full_sync_interval_days'])
+  if previous_snapshot is None:
+    logger.info("No previous snapshot found; performing a full sync....")
+  elif previous_overrides is None:
+    logger.info("No previous override memberships found; performing a full sync....")
+  elif last_full_sync is None or script_begin_time - last_full_sync >= full_sync_interval:
+    logger.info("Last full sync was at %s; performing a full sync...." % last_full_sync)
+  else:
+    full_sync = False
+    current_states = { andrewId: (S3.is_billable(andrewId), coalesced_student_privileges[andrewId]) for andrewId in coalesced_student_privileges }
+    changed_andrewIds = snapshot.get_changed_users(previous_snapshot, current_states)
+    tracked_andrewIds.update(previous_snapshot['users'].keys())
+    logger.info("Performing an incremental sync for %d users whose state changed since %s...." % (len(changed_andrewIds), previous_snapshot['timestamp']))
+    for andrewId in sorted(changed_andrewIds):
+      logger.debug("  %s" % andrewId)
+    del current_states
+  del previous_snapshot
+else:
+  logger.info("Performing a full sync....")
+if previous_overrides is None:
+  previous_overrides = {}
+
+# Until this run has reconciled every downstream system without error, the
+# next run must be a full sync, since the snapshot written below would
+# otherwise hide any changes which this run failed to apply.  The record of
+# the last full sync is restored in the epilogue if all goes well.
+snapshot.clear_full_sync_time(full_sync_path)
+reconcile_errors = 0
+
+def get_overrides(group):
+  # Return the members of the override `group` from Grouper, recording them
+  # for `to_reconcile()` and for the next run.
+  members = Grouper.get_members(group)
+  current_overrides[group] = members
+  return members
+
+def to_reconcile(andrewIds, override_groups=()):
+  # Limit a set of users to those which should be reconciled in this run.
+  # Current and former members of any of `override_groups` are always
+  # reconciled, since the snapshot doesn't reflect changes to them.
+  if full_sync:
+    return andrewIds
+  overridden = set()
+  for group in override_groups:
+    overridden.update(current_overrides.get(group, ()))
+    overridden.update(previous_overrides.get(group, ()))
+  return { x for x in andrewIds if x in changed_andrewIds or x in overridden or x not in tracked_andrewIds }
+
+
 
 # Now that we have calculated the set of privileges for each student, generate
 # various outputs.
@@ -390,32 +400,28 @@ del all_student_privileges
 
 
 #   0. Generate and store locally a JSON representation of the calculated data.
-#        - TODO: Check diffs between the current version of this data and the
-#          most recently cached version before determining what actions should
-#          be taken on any downstream systems.
 jsondata_dir = pathlib.Path(config['output_dirs']['jsondata']).resolve()
 jsondata_dir.mkdir(parents=True, exist_ok=True)
 jsondata_file = "data-%s.json" % run_date
 jsondata_path = pathlib.Path(jsondata_dir, jsondata_file).resolve()
+jsondata_index_file = "data-%s.sqlite" % run_date
+jsondata_index_path = pathlib.Path(jsondata_dir, jsondata_index_file).resolve()
 logger.info("Generating JSON file to locally cache calculated data at `%s`...." % jsondata_path)
 
-all_data = {
-  'timestamp': script_begin_time.isoformat(),
-  'users': {}
-}
-for student in S3.students:
-  all_data['users'][student] = {
-    'academic': S3.students[student].data['academic'],
-    'biographical': S3.students[student].data['biographical'],
-    'privileges': coalesced_student_privileges[student],
-    'sections': S3.student_sections[student]
-  }
-
-# Write out the file.
-with open(jsondata_path, 'w') as jsonfile:
-  jsonfile.write(json.dumps(all_data, sort_keys=True, indent=2, cls=helpers.CustomJSONEncoder))
+# Write out the file, one user at a time.
+all_user_data = ( (student, {
+  'academic': S3.students[student].data['academic'],
+  'biographical': S3.students[student].data['biographical'],
+  'privileges': coalesced_student_privileges[student],
+  'sections': S3.student_sections[student]
+}) for student in sorted(S3.students) )
+snapshot.write(jsondata_path, script_begin_time.isoformat(), all_user_data, jsondata_index_path)
+del all_user_data
 jsondata_link = pathlib.Path(jsondata_dir, "latest.json").absolute()
 subprocess.call(["ln", "-sf", jsondata_file, jsondata_link])
+# Also keep an index of this data for quick lookups of individual users.
+jsondata_index_link = pathlib.Path(jsondata_dir, "latest.sqlite").absolute()
+subprocess.call(["ln", "-sf", jsondata_index_file, jsondata_index_link])
 
 
 #   1. Generate XML file for door/keycard ACL management, upload via SFTP with
@@ -427,9 +433,26 @@ keycard_dir = pathlib.Path(config['output_dirs']['keycard']).resolve()
 keycard_dir.mkdir(parents=True, exist_ok=True)
 keycard_file = "keycard-%s.xml" % run_date
 keycard_path = pathlib.Path(keycard_dir, keycard_file).resolve()
+keycard_delta_file = "keycard-delta-%s.xml" % run_date
+keycard_delta_path = pathlib.Path(keycard_dir, keycard_delta_file).resolve()
+
+# Only new or changed assignments are uploaded, so load the full set of
+# assignments as of the last successful upload to compare against.  If there
+# is none, everything is uploaded.
+keycard_uploaded_link = pathlib.Path(keycard_dir, "uploaded.xml").absolute()
+if keycard_uploaded_link.is_file():
+  keycard_uploaded_file = keycard_uploaded_link.resolve().name
+  logger.info("Loading door/keycard ACLs as of last upload from `%s`...." % keycard_uploaded_file)
+  uploaded_assignments = CsGoldData.load_access_assignments(keycard_uploaded_link)
+else:
+  keycard_uploaded_file = None
+  logger.info("No previously uploaded door/keycard ACLs found; all ACLs will be uploaded.")
+  uploaded_assignments = {}
 
+# Both files are written out as each assignment is generated.
 logger.info("Generating XML file for CSGold door/keycard ACLs at `%s`...." % keycard_path)
-keycard_data = CsGoldData(comment='Generated as \'%s\' by ACLMAN at %s' % (keycard_file, helpers.now()))
+keycard_data = CsGoldData(comment='Generated as \'%s\' by ACLMAN at %s' % (keycard_file, helpers.now()), path=keycard_path)
+keycard_delta = CsGoldData(comment='Generated as \'%s\' by ACLMAN at %s; changes since \'%s\'' % (keycard_delta_file, helpers.now(), keycard_uploaded_file), path=keycard_delta_path)
 
 # Generate the elements for each access privilege.
 for andrewId in sorted(coalesced_student_privileges.keys()):
@@ -442,18 +465,15 @@ for andrewId in sorted(coalesced_student_privileges.keys()):
 
   for privilege in coalesced_student_privileges[andrewId]:
     # NOTE: For most access (apart from summer access handled specially below),
-    # this process will even add old, expired privileges to the file;
+    # this process will even add old, expired privileges to the full file;
     # as long as a student remains enrolled, their old entries will be added.
-    # When they're re-uploaded, such records will live in the patron group for
-    # a few hours afterwards before being deleted as expired by the CSGold
-    # server.  We can avoid such churn by first checking against a copy of
-    # what's already on the server and not adding privileges which are both old
-    # and already dropped from the server.  (If, on the contrary, we calculate
-    # a privilege as old here, but it is current on the server, we do want to
-    # re-upload it, as that's likely been caused by a drop.)
-    # TODO: Request access to such a feature, and/or track the server state to
-    # calculate diffs.  This would also have the added benefit that we could
-    # avoid re-uploading ANY privilege which hasn't changed.
+    # Were they re-uploaded, such records would live in the patron group for a
+    # few hours afterwards before being deleted as expired by the CSGold
+    # server.  We avoid such churn by only uploading assignments which are new
+    # or changed since the last successful upload.
+    # TODO: Request access to a copy of what's actually on the server.  (If we
+    # calculate a privilege as old here, but it is current on the server, we
+    # do want to re-upload it, as that's likely been caused by a drop.)
 
     # NOTE: Beginning Fall 2021, door access to HL A5 is provisioned as part of
     # the "base" privilege; it is no longer provisioned as a standard
@@ -485,29 +505,43 @@ for andrewId in sorted(coalesced_student_privileges.keys()):
     # privilege is current or future (i.e., not expired).
     if privilege.end >= datetime.datetime.now() or not summer_access:
       keycard_data.append_access_assignment(andrewId, groupId, start_date, end_date, comment)
+      # Also add it to the delta if it is new or has changed.
+      previous_dates = uploaded_assignments.get((andrewId, groupId))
+      if previous_dates != (start_date, end_date):
+        logger.debug("%-8s %s: %s -> %s" % (andrewId, groupId, previous_dates, (start_date, end_date)))
+        keycard_delta.append_access_assignment(andrewId, groupId, start_date, end_date, comment)
+
+del uploaded_assignments
 
-# Write out the file.
-with open(keycard_path, 'w') as xmlfile:
-  xmlfile.write(keycard_data.export_xml())
+# Finish writing out the files.
+keycard_data.close()
+keycard_delta.close()
 keycard_link = pathlib.Path(keycard_dir, "latest.xml").absolute()
 subprocess.call(["ln", "-sf", keycard_file, keycard_link])
 
-# Upload the file via SFTP to the CSGold Util server.
-logger.info("Uploading XML file for door/keycard ACLs to CSGold Util %s server...." % config['environment'])
-
-# Read SFTP commands from stdin with "-b -", given in the input argument.
-# Suppress verbose SFTP output with the `stdout=subprocess.DEVNULL` option.
-# Errors will still be piped to stderr.
-result = subprocess.run(["sftp", "-b", "-", "-i", secrets['csgold_util']['ssh_key_path'],
-  "%s@%s" % (secrets['csgold_util']['username'], secrets['csgold_util']['fqdn'])],
-  stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
-  input=b"put %s Drop/" % bytes(keycard_path))
-if result.returncode != 0:
-  logger.error("SFTP error %d:\n%s" % (result.returncode, result.stderr.decode('utf-8')))
-
-# TODO: Compare the just-generated ACL file with the previous version and log
-# the diffs locally.  This will make the reasons for drops easier to determine
-# empirically.
+if len(keycard_delta) == 0:
+  logger.info("No door/keycard ACLs are new or changed since the last upload; skipping upload.")
+  keycard_delta_path.unlink()
+  subprocess.call(["ln", "-sf", keycard_file, keycard_uploaded_link])
+else:
+  logger.info("Generated XML file for %d new or changed CSGold door/keycard ACLs at `%s`." % (len(keycard_delta), keycard_delta_path))
+
+  # Upload the delta file via SFTP to the CSGold Util server.
+  logger.info("Uploading XML file for door/keycard ACLs to CSGold Util %s server...." % config['environment'])
+
+  # Read SFTP commands from stdin with "-b -", given in the input argument.
+  # Suppress verbose SFTP output with the `stdout=subprocess.DEVNULL` option.
+  # Errors will still be piped to stderr.
+  result = subprocess.run(["sftp", "-b", "-", "-i", secrets['csgold_util']['ssh_key_path'],
+    "%s@%s" % (secrets['csgold_util']['username'], secrets['csgold_util']['fqdn'])],
+    stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+    input=b"put %s Drop/" % bytes(keycard_delta_path))
+  if result.returncode != 0:
+    logger.error("SFTP error %d:\n%s" % (result.returncode, result.stderr.decode('utf-8')))
+  else:
+    # Only once the upload succeeds, mark the full file as what the server has,
+    # so that a failed upload is retried in full next time.
+    subprocess.call(["ln", "-sf", keycard_file, keycard_uploaded_link])
 
 
 #   2. Populate Grouper group for base community privileges.  In particular,
@@ -539,26 +573,28 @@ for andrewId in sorted(coalesced_student_privileges.keys()):
 
 # Determine differences between current and calculated group membership.
 logger.info("Determining group membership differences....")
-grouper_to_del = existing_andrewIds.difference(calculated_andrewIds)
-grouper_to_add = calculated_andrewIds.difference(existing_andrewIds)
+grouper_to_del = to_reconcile(existing_andrewIds.difference(calculated_andrewIds))
+grouper_to_add = to_reconcile(calculated_andrewIds.difference(existing_andrewIds))
 
 # Add and remove members as determined.
 logger.info("Removing %d members from group `%s`...." % (len(grouper_to_del), base_privileges_group))
-for andrewId in sorted(grouper_to_del):
-  try:
-    Grouper.remove_member(base_privileges_group, andrewId)
+grouper_results = Grouper.remove_members(base_privileges_group, grouper_to_del)
+for andrewId, result in sorted(grouper_results.items()):
+  if Grouper.is_success(result):
     logger.debug("  Removed %s", andrewid_str(andrewId))
-  except urllib.error.HTTPError as e:
-    sys.stderr.write("  Grouper error while removing member %s: %s\n" % (andrewId, e))
-    logger.error("  Grouper error while removing member %s: %s" % (andrewId, e))
+  else:
+    sys.stderr.write("  Grouper error while removing member %s: %s\n" % (andrewId, result))
+    logger.error("  Grouper error while removing member %s: %s" % (andrewId, result))
+    reconcile_errors += 1
 logger.info("Adding %d members to group `%s`...." % (len(grouper_to_add), base_privileges_group))
-for andrewId in sorted(grouper_to_add):
-  try:
-    Grouper.add_member(base_privileges_group, andrewId)
+grouper_results = Grouper.add_members(base_privileges_group, grouper_to_add)
+for andrewId, result in sorted(grouper_results.items()):
+  if Grouper.is_success(result):
     logger.debug("  Added %s", andrewid_str(andrewId))
-  except urllib.error.HTTPError as e:
-    sys.stderr.write("  Grouper error while adding member %s: %s\n" % (andrewId, e))
-    logger.error("  Grouper error while adding member %s: %s" % (andrewId, e))
+  else:
+    sys.stderr.write("  Grouper error while adding member %s: %s\n" % (andrewId, result))
+    logger.error("  Grouper error while adding member %s: %s" % (andrewId, result))
+    reconcile_errors += 1
 
 
 #   3. Generate access lists for room reservation privileges in MRBS; update
@@ -566,68 +602,82 @@ for andrewId in sorted(grouper_to_add):
 #        - NOTE: Enrollment data is NOT nominaly needed here, as this privilege
 #          is only granted for the current semester for HL A10A only.
 
+# Get the existing members of all mapped rooms at once.
+mrbs_privilege_types = [ x for x in all_privilege_types if x.key == "room_reservation" ]
+mrbs_roomIds = [ config['mrbs_room_mapping'][x.value] for x in mrbs_privilege_types ]
+logger.info("Getting existing MRBS ACLs for %d rooms...." % len(mrbs_roomIds))
+all_existing_mrbs_andrewIds = Mrbs.get_all_members(mrbs_roomIds)
+
 # Iterate over all 'room_reservation' privilege types.
-for privilege_type in all_privilege_types:
-  if privilege_type.key != "room_reservation":
-    continue
-  else:
-    mrbs_roomNumber = privilege_type.value
-    mrbs_roomId = config['mrbs_room_mapping'][mrbs_roomNumber]
-
-    # Get the existing group members.
-    logger.info("Getting existing MRBS ACLs for %s (room ID %d)...." % (mrbs_roomNumber, mrbs_roomId))
-    existing_andrewIds = Mrbs.get_members(mrbs_roomId)
-
-    # Calculate who should be in the group based on privileges.
-    logger.info("Calculating new MRBS ACL memberships for %s (room ID %d)...." % (mrbs_roomNumber, mrbs_roomId))
-    calculated_andrewIds = set()
-    for andrewId in sorted(coalesced_student_privileges.keys()):
-      for privilege in [x for x in coalesced_student_privileges[andrewId] if x.key == "room_reservation" and x.value == mrbs_roomNumber]:
-        if privilege.is_current():
-          calculated_andrewIds.add(andrewId)
-    # Add positive overrides to calculated list.
-    # These are typically faculty or student employees who need reservation
-    # privileges but would not receive them through enrollment in a course.
-    # Get these from Grouper.
-    logger.info("Adding positive overrides....")
-    mrbs_overrides = Grouper.get_members("Apps:IDeATe:Permissions:Room Reservation:%s - Overrides Positive" % mrbs_roomNumber)
-    for andrewId in mrbs_overrides:
-      calculated_andrewIds.add(andrewId)
+mrbs_changes = []
+for privilege_type in mrbs_privilege_types:
+  mrbs_roomNumber = privilege_type.value
+  mrbs_roomId = config['mrbs_room_mapping'][mrbs_roomNumber]
+  existing_andrewIds = all_existing_mrbs_andrewIds[mrbs_roomId]
+
+  # Calculate who should be in the group based on privileges.
+  logger.info("Calculating new MRBS ACL memberships for %s (room ID %d)...." % (mrbs_roomNumber, mrbs_roomId))
+  calculated_andrewIds = set()
+  for andrewId in sorted(coalesced_student_privileges.keys()):
+    for privilege in [x for x in coalesced_student_privileges[andrewId] if x.key == "room_reservation" and x.value == mrbs_roomNumber]:
+      if privilege.is_current():
+        calculated_andrewIds.add(andrewId)
+  # Add positive overrides to calculated list.
+  # These are typically faculty or student employees who need reservation
+  # privileges but would not receive them through enrollment in a course.
+  # Get these from Grouper.
+  logger.info("Adding positive overrides....")
+  mrbs_overrides_group = "Apps:IDeATe:Permissions:Room Reservation:%s - Overrides Positive" % mrbs_roomNumber
+  mrbs_overrides = get_overrides(mrbs_overrides_group)
+  for andrewId in mrbs_overrides:
+    calculated_andrewIds.add(andrewId)
 
-    # Determine differences between current and calculated group membership.
-    logger.info("Determining group membership differences....")
-    mrbs_to_del = existing_andrewIds.difference(calculated_andrewIds)
-    mrbs_to_add = calculated_andrewIds.difference(existing_andrewIds)
-
-    if not live:
-      # Since there is presently no development environment for MRBS, take no
-      # action in DEVELOPMENT mode; rather, simply output the calculated
-      # differences.
-      logger.info("Environment is %s; NOT adding/removing MRBS users." % config['environment'])
-      logger.debug("%d members should be removed from MRBS ACL for %s (room ID %d)...." % (len(mrbs_to_del), mrbs_roomNumber, mrbs_roomId))
-      for andrewId in sorted(mrbs_to_del):
-        logger.debug("  %s", andrewid_str(andrewId))
-      logger.debug("%d members should be added to MRBS ACL for %s (room ID %d)...." % (len(mrbs_to_add), mrbs_roomNumber, mrbs_roomId))
-      for andrewId in sorted(mrbs_to_add):
-        logger.debug("  %s", andrewid_str(andrewId))
-    else:
-      # In PRODUCTION, add and remove members as determined.
-      logger.info("Removing %d members from MRBS ACL for %s (room ID %d)...." % (len(mrbs_to_del), mrbs_roomNumber, mrbs_roomId))
-      for andrewId in sorted(mrbs_to_del):
-        try:
-          Mrbs.remove_member(mrbs_roomId, andrewId)
-          logger.debug("  Removed %s", andrewid_str(andrewId))
-        except:
-          sys.stderr.write("  MRBS error while removing member %s!\n" % andrewId)
-          logger.error("  MRBS error while removing member %s!" % andrewId)
-      logger.info("Adding %d members to MRBS ACL for %s (room ID %d)...." % (len(mrbs_to_add), mrbs_roomNumber, mrbs_roomId))
-      for andrewId in sorted(mrbs_to_add):
-        try:
-          Mrbs.add_member(mrbs_roomId, andrewId)
-          logger.debug("  Added %s", andrewid_str(andrewId))
-        except:
-          sys.stderr.write("  MRBS error while adding member %s!\n" % andrewId)
-          logger.error("  MRBS error while adding member %s!" % andrewId)
+  # Determine differences between current and calculated group membership.
+  logger.info("Determining group membership differences....")
+  mrbs_to_del = to_reconcile(existing_andrewIds.difference(calculated_andrewIds), [mrbs_overrides_group])
+  mrbs_to_add = to_reconcile(calculated_andrewIds.difference(existing_andrewIds), [mrbs_overrides_group])
+  mrbs_changes.append((mrbs_roomNumber, mrbs_roomId, mrbs_to_del, mrbs_to_add))
+
+if not live:
+  # Since there is presently no development environment for MRBS, take no
+  # action in DEVELOPMENT mode; rather, simply output the calculated
+  # differences.
+  logger.info("Environment is %s; NOT adding/removing MRBS users." % config['environment'])
+  for (mrbs_roomNumber, mrbs_roomId, mrbs_to_del, mrbs_to_add) in mrbs_changes:
+    logger.debug("%d members should be removed from MRBS ACL for %s (room ID %d)...." % (len(mrbs_to_del), mrbs_roomNumber, mrbs_roomId))
+    for andrewId in sorted(mrbs_to_del):
+      logger.debug("  %s", andrewid_str(andrewId))
+    logger.debug("%d members should be added to MRBS ACL for %s (room ID %d)...." % (len(mrbs_to_add), mrbs_roomNumber, mrbs_roomId))
+    for andrewId in sorted(mrbs_to_add):
+      logger.debug("  %s", andrewid_str(andrewId))
+else:
+  # In PRODUCTION, add and remove members as determined.  First, determine
+  # which of the members to be added are in the MRBS database at all.
+  logger.info("Getting existing MRBS users....")
+  existing_mrbs_eppns = Mrbs.get_existing_users(Mrbs.get_eppn(andrewId) for (_, _, _, mrbs_to_add) in mrbs_changes for andrewId in mrbs_to_add)
+  for (mrbs_roomNumber, mrbs_roomId, mrbs_to_del, mrbs_to_add) in mrbs_changes:
+    # Each batch is applied in a single transaction where possible; failures
+    # are still reported for each member.
+    logger.info("Removing %d members from MRBS ACL for %s (room ID %d)...." % (len(mrbs_to_del), mrbs_roomNumber, mrbs_roomId))
+    mrbs_results = Mrbs.remove_members(mrbs_roomId, mrbs_to_del)
+    for andrewId, result in sorted(mrbs_results.items()):
+      if result is None:
+        logger.debug("  Removed %s", andrewid_str(andrewId))
+      else:
+        sys.stderr.write("  MRBS error while removing member %s: %s\n" % (andrewId, result))
+        logger.error("  MRBS error while removing member %s: %s" % (andrewId, result))
+        reconcile_errors += 1
+    logger.info("Adding %d members to MRBS ACL for %s (room ID %d)...." % (len(mrbs_to_add), mrbs_roomNumber, mrbs_roomId))
+    mrbs_results = Mrbs.add_members(mrbs_roomId, mrbs_to_add, existing_mrbs_eppns)
+    for andrewId, result in sorted(mrbs_results.items()):
+      if result is None:
+        logger.debug("  Added %s", andrewid_str(andrewId))
+      else:
+        sys.stderr.write("  MRBS error while adding member %s: %s\n" % (andrewId, result))
+        logger.error("  MRBS error while adding member %s: %s" % (andrewId, result))
+        reconcile_errors += 1
+
+Mrbs.close()
 
 
 #   4. Compare with a dump of existing user lists from Zoho/Quartermaster for
@@ -638,7 +688,7 @@ for privilege_type in all_privilege_types:
 #          contemporaneously enrolled in the course which conferred this
 #          privilege.  We accomplish this with the calculated `billable` flag.
 
-# Get a fresh auth token.
+# Get a valid auth token, refreshing it if needed.
 logger.info("Getting Zoho auth token...")
 Zoho.authenticate()
 
@@ -669,7 +719,7 @@ zoho_to_add = set()
 zoho_to_activate = set()
 zoho_to_deactivate = set()
 
-for andrewId in calculated_andrewIds.difference(existing_andrewIds):
+for andrewId in to_reconcile(calculated_andrewIds.difference(existing_andrewIds)):
   billable = S3.is_billable(andrewId)
   # If not listed in Zoho, add the user as long as they're billable.
   # NOTE: Since the user is being added due to their enrollment, it is assumed
@@ -713,7 +763,7 @@ for andrewId in calculated_andrewIds.difference(existing_andrewIds):
 # TODO: Further work may disentagle the edge cases caused by the actual
 # orthogonality of these roles.  For now, copiously warn by logging an error
 # upon activating or deactivating users with any role other than "Student".
-for andrewId in existing_andrewIds:
+for andrewId in to_reconcile(existing_andrewIds):
   user = zoho_users[andrewId]
   billable = S3.is_billable(andrewId)
   # If already Inactive, but privilege is calculated as current, reactivate
@@ -779,31 +829,49 @@ if not live:
   for andrewId in sorted(zoho_to_add):
     logger.debug("  %s", andrewid_str(andrewId))
 else:
-  # In PRODUCTION, add and remove members as determined.
+  # In PRODUCTION, add and remove members as determined.  Activations and
+  # deactivations use the records already fetched above.
   logger.info("Deactivating %d members in Zoho user list...." % len(zoho_to_deactivate))
+  try:
+    zoho_results = Zoho.deactivate_users([ zoho_users[x] for x in zoho_to_deactivate ])
+  except Exception as e:
+    zoho_results = { andrewId: (None, e) for andrewId in zoho_to_deactivate }
   for andrewId in sorted(zoho_to_deactivate):
-    try:
-      Zoho.deactivate_user(andrewId)
+    # Users needing no change are absent from the results.
+    (code, message) = zoho_results.get(andrewId, (Zoho.SUCCESS, None))
+    if code == Zoho.SUCCESS:
       logger.debug("  Deactivated %s", andrewid_str(andrewId))
-    except:
-      sys.stderr.write("  Zoho error while deactivating member %s!\n" % andrewId)
-      logger.error("  Zoho error while deactivating member %s!" % andrewId)
+    else:
+      sys.stderr.write("  Zoho error while deactivating member %s: %s\n" % (andrewId, message))
+      logger.error("  Zoho error while deactivating member %s: %s" % (andrewId, message))
+      reconcile_errors += 1
   logger.info("Activating %d members in Zoho user list...." % len(zoho_to_activate))
+  try:
+    zoho_results = Zoho.activate_users([ zoho_users[x] for x in zoho_to_activate ])
+  except Exception as e:
+    zoho_results = { andrewId: (None, e) for andrewId in zoho_to_activate }
   for andrewId in sorted(zoho_to_activate):
-    try:
-      Zoho.activate_user(andrewId)
+    # Users needing no change are absent from the results.
+    (code, message) = zoho_results.get(andrewId, (Zoho.SUCCESS, None))
+    if code == Zoho.SUCCESS:
       logger.debug("  Activated %s", andrewid_str(andrewId))
-    except:
-      sys.stderr.write("  Zoho error while activating member %s!\n" % andrewId)
-      logger.error("  Zoho error while activating member %s!" % andrewId)
+    else:
+      sys.stderr.write("  Zoho error while activating member %s: %s\n" % (andrewId, message))
+      logger.error("  Zoho error while activating member %s: %s" % (andrewId, message))
+      reconcile_errors += 1
   logger.info("Adding %d members to Zoho user list...." % len(zoho_to_add))
+  try:
+    zoho_results = Zoho.add_users(zoho_to_add)
+  except Exception as e:
+    zoho_results = { andrewId: (None, e) for andrewId in zoho_to_add }
   for andrewId in sorted(zoho_to_add):
-    try:
-      Zoho.add_user(andrewId)
+    (code, message) = zoho_results.get(andrewId, (None, "No result for record"))
+    if code == Zoho.SUCCESS:
       logger.debug("  Added %s", andrewid_str(andrewId))
-    except:
-      sys.stderr.write("  Zoho error while adding member %s!\n" % andrewId)
-      logger.error("  Zoho error while adding member %s!" % andrewId)
+    else:
+      sys.stderr.write("  Zoho error while adding member %s: %s\n" % (andrewId, message))
+      logger.error("  Zoho error while adding member %s: %s" % (andrewId, message))
+      reconcile_errors += 1
 
 
 #   5. Provision access to Stratasys Skylab for 3D printing.
@@ -831,7 +899,7 @@ groups = [ config['grouper_groups']['access']['skylab_instructor'],
          ]
 for group in groups:
   logger.info("Getting override ACL group memberships for `%s`...." % group)
-  for andrewId in Grouper.get_members(group):
+  for andrewId in get_overrides(group):
     calculated_andrewIds.add(andrewId)
 # Calculate who else should have access based on privileges.
 logger.info("Calculating new privilege-based users for Skylab....")
@@ -844,8 +912,8 @@ for andrewId in sorted(coalesced_student_privileges.keys()):
 
 # Determine differences between current and calculated ACL.
 logger.info("Determining user list differences....")
-skylab_to_disable = existing_andrewIds.difference(calculated_andrewIds)
-skylab_to_enable = calculated_andrewIds.difference(existing_andrewIds)
+skylab_to_disable = to_reconcile(existing_andrewIds.difference(calculated_andrewIds), groups)
+skylab_to_enable = to_reconcile(calculated_andrewIds.difference(existing_andrewIds), groups)
 
 if not live:
   # Since there is presently no development environment for Skylab, take no
@@ -868,6 +936,7 @@ else:
     except Exception as e:
       sys.stderr.write("  Skylab error while adding/enabling member %s: %s\n" % (andrewId, e))
       logger.error("  Skylab error while adding/enabling member %s: %s" % (andrewId, e))
+      reconcile_errors += 1
   logger.info("Adding/Enabling %d users to Skylab...." % len(skylab_to_enable))
   for andrewId in sorted(skylab_to_enable):
     try:
@@ -877,6 +946,7 @@ else:
     except Exception as e:
       sys.stderr.write("  Skylab error while adding/enabling member %s: %s\n" % (andrewId, e))
       logger.error("  Skylab error while adding/enabling member %s: %s" % (andrewId, e))
+      reconcile_errors += 1
 
 
 
@@ -915,6 +985,13 @@ subprocess.call(["ln", "-sf", roster_file, roster_link])
 
 
 # Epilogue.
+snapshot.write_overrides(overrides_path, current_overrides)
+if reconcile_errors:
+  logger.warning("Encountered %d errors while reconciling downstream systems; the next run will be a full sync." % reconcile_errors)
+elif full_sync:
+  snapshot.write_full_sync_time(full_sync_path, script_begin_time)
+else:
+  snapshot.write_full_sync_time(full_sync_path, last_full_sync)
 script_end_time = helpers.now()
 logger.info("Done with %s run." % config['environment'])
 script_elapsed = (script_end_time - script_begin_time).total_seconds()
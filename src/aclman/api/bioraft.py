@@ -1,37 +1,47 @@
-import functools
 import urllib.request
 import json
 
 from datetime import datetime, timedelta
 import jwt
 
+from .. import cache
 from .. import config_handler
 from .. import helpers
+from .. import tokens
+from . import transport
 
 secrets = None
 training_courses = None
+course_catalog = None
+course_catalog_refreshed = False
+missing_courses = None
 
 
 def load_secrets():
   global secrets
   secrets = config_handler.get_secrets('bioraft_api')
-  authenticate()
 
 def authenticate():
+  # Get a signed JWT, reusing a stored one until shortly before it expires.
   if secrets is None:
     load_secrets()
 
+  secrets['jwt_token'] = tokens.get_token("bioraft:%s:%s" % (secrets['key_id'], secrets['user_id']), __sign_jwt)
+  return secrets['jwt_token']
+
+def __sign_jwt():
   now = helpers.now()
+  lifetime = timedelta(hours=1)
   payload = {
     'iat': now - timedelta(minutes=5),
-    'exp': now + timedelta(hours=1),
+    'exp': now + lifetime,
     'drupal': { 'uid': secrets['user_id'] }
   }
   with open(secrets['ssh_key_path'], 'rb') as fh:
     rsa_key = fh.read()
 
   encoded = jwt.encode(payload, rsa_key, algorithm='RS256', headers={ 'kid': secrets['key_id'] } )
-  secrets['jwt_token'] = encoded
+  return (encoded, lifetime.total_seconds())
 
 def load_training_courses():
   global training_courses
@@ -50,101 +60,161 @@ def get_course_training_records(course_id, training_days):
     'filter[creAft][condition][path]': 'created',
     'filter[creAft][condition][operator]': '>=',
     'filter[creAft][condition][value]': (datetime.utcnow() - timedelta(days=training_days)).timestamp(),
+    # Sideload each trainee's identity along with their records.
+    'include': 'user_id',
+    'fields[raft_training_record--raft_training_record]': 'created,user_id',
+    'fields[user--user]': 'mail,drupal_internal__uid,status',
+    # NOTE: This is the maximum page size allowed by JSON:API in Drupal.
     'page[offset]': 0,
     'page[limit]': 50
   }
   endpoint = "%s/jsonapi/raft_training_record/raft_training_record?%s" % (secrets['hostname'], urllib.parse.urlencode(get_params))
-  headers = {
-    'Authorization': 'UsersJwt %s' % secrets['jwt_token']
-  }
 
   while True:
+    headers = {
+      'Authorization': 'UsersJwt %s' % authenticate()
+    }
     req = urllib.request.Request(endpoint, headers=headers, method='GET')
     try:
-      resp = urllib.request.urlopen(req).read()
+      resp = transport.urlopen(req).read()
       resp_data = json.loads(resp.decode('utf-8'))
-      for entry in resp_data['data']:
-        yield entry
-      # Get next endpoint URL
-      endpoint = resp_data['links']['next']['href']
-    except KeyError:  # no next endpoint
-      return
     except urllib.error.HTTPError as e:
       raise Exception("BioRAFT error %s" % (e))
+    for entry in resp_data.get('included', []):
+      if entry['type'] == 'user--user':
+        __record_user(entry)
+    for entry in resp_data['data']:
+      yield entry
+    # Get next endpoint URL, if any.
+    next_link = resp_data.get('links', {}).get('next')
+    if next_link is None:
+      return
+    endpoint = next_link['href']
 
 def get_recent_trainings(course_id, training_days):
+  # NOTE: Trainees are sideloaded with their training records, so their Andrew
+  # IDs are usually already known without any further requests.
   for entry in get_course_training_records(course_id, training_days):
     user_uuid = entry['relationships']['user_id']['data']['id']
     created = entry['attributes']['created']
     andrewId = translate_user_uuid_to_andrewid(user_uuid)
     yield ( andrewId, created )
 
-@functools.cache
-def translate_user_uuid_to_andrewid(user_id):
+# BioRAFT user identities, each a dictionary of a user's `uuid`, numeric `uid`,
+# (lowercase) `andrewId`, and whether their account is active (`status`), keyed
+# by UUID and by Andrew ID, respectively.  These are persisted in the cache,
+# since they rarely change.
+users_by_uuid = {}
+users_by_andrewid = {}
+
+def __supersedes(identity, existing):
+  # Return whether `identity` should replace the `existing` identity (if any)
+  # for its Andrew ID.  BioRAFT may have more than one account with the same
+  # mail, so an active account is never replaced by a different, inactive one.
+  if existing is None or existing['uuid'] == identity['uuid']:
+    return True
+  return identity.get('status', True) or not existing.get('status', True)
+
+def __remember_user(identity):
+  users_by_uuid[identity['uuid']] = identity
+  if __supersedes(identity, users_by_andrewid.get(identity['andrewId'])):
+    users_by_andrewid[identity['andrewId']] = identity
+
+def __record_user(entry):
+  identity = {
+    'uuid': entry['id'],
+    'uid': entry['attributes']['drupal_internal__uid'],
+    'andrewId': entry['attributes']['mail'].lower().replace("@andrew.cmu.edu",""),
+    'status': bool(entry['attributes']['status'])
+  }
+  __remember_user(identity)
+  cache.get_cache().set('bioraft_user_uuid', identity['uuid'], identity)
+  cached = cache.get_cache().get('bioraft_user_andrewid', identity['andrewId'], cache.get_ttl('bioraft_users'))
+  if __supersedes(identity, cached):
+    cache.get_cache().set('bioraft_user_andrewid', identity['andrewId'], identity)
+  return identity
+
+def __resolve_users(keys, known, namespace, path, value, active=False):
+  # Return a dictionary mapping each of `keys` to its user identity, omitting
+  # any which don't exist, or which aren't active if `active` is set.
+  # Identities are taken from memory or the cache if possible; the rest are
+  # fetched in bulk with `IN` filters on `path`, whose values are given by
+  # `value(key)`.
+  identities = {}
+  missing = []
+  for key in sorted(set(keys)):
+    identity = known.get(key)
+    if identity is None:
+      identity = cache.get_cache().get(namespace, key, cache.get_ttl('bioraft_users'))
+      if identity is not None:
+        __remember_user(identity)
+    # NOTE: Identities cached before their status was recorded are refetched
+    # if it's needed.
+    if identity is None or (active and 'status' not in identity):
+      missing.append(key)
+    elif not active or identity['status']:
+      identities[key] = identity
+  if not missing:
+    return identities
+
   if secrets is None:
     load_secrets()
+  batch_size = 50
+  for i in range(0, len(missing), batch_size):
+    batch = missing[i:i+batch_size]
+    get_params = {
+      'fields[user--user]': 'mail,drupal_internal__uid,status',
+      'filter[key][condition][path]': path,
+      'filter[key][condition][operator]': 'IN',
+      'page[limit]': batch_size
+    }
+    for j, key in enumerate(batch):
+      get_params['filter[key][condition][value][%d]' % j] = value(key)
+    endpoint = "%s/jsonapi/user/user?%s" % (secrets['hostname'], urllib.parse.urlencode(get_params))
+    headers = {
+      'Authorization': 'UsersJwt %s' % authenticate()
+    }
+    req = urllib.request.Request(endpoint, headers=headers, method='GET')
+    try:
+      resp = transport.urlopen(req).read()
+      resp_data = json.loads(resp.decode('utf-8'))
+    except urllib.error.HTTPError as e:
+      raise Exception("BioRAFT error %s" % (e))
+    for entry in resp_data['data']:
+      __record_user(entry)
+    for key in batch:
+      if key in known and (not active or known[key]['status']):
+        identities[key] = known[key]
+  return identities
+
+def resolve_uuids(uuids):
+  # Return a dictionary mapping each of the user `uuids` to its identity.
+  return __resolve_users(uuids, users_by_uuid, 'bioraft_user_uuid', 'id', lambda x: x)
+
+def resolve_andrewids(andrewIds):
+  # Return a dictionary mapping each of the (active) users' `andrewIds` to its
+  # identity.  Andrew IDs are matched regardless of case.
+  andrewIds = set(andrewIds)
+  identities = __resolve_users((x.lower() for x in andrewIds), users_by_andrewid, 'bioraft_user_andrewid', 'mail', lambda x: '%s@andrew.cmu.edu' % x, active=True)
+  return { x: identities[x.lower()] for x in andrewIds if x.lower() in identities }
 
-  endpoint = "%s/jsonapi/user/user/%s" % (secrets['hostname'], user_id)
-  headers = {
-    'Authorization': 'UsersJwt %s' % secrets['jwt_token']
-  }
-  req = urllib.request.Request(endpoint, headers=headers, method='GET')
+def translate_user_uuid_to_andrewid(user_id):
   try:
-    resp = urllib.request.urlopen(req).read()
-    resp_data = json.loads(resp.decode('utf-8'))
-    return resp_data['data']['attributes']['mail'].replace("@andrew.cmu.edu","")
-  except urllib.error.HTTPError as e:
-    raise Exception("BioRAFT error %s" % (e))
+    return resolve_uuids([user_id])[user_id]['andrewId']
+  except KeyError:
+    raise Exception("No such user %s" % (user_id))
 
-@functools.cache
 def translate_andrewid_to_user_uuid(andrewId):
-  if secrets is None:
-    load_secrets()
-
-  get_params = {
-    'filter[status]': 1,
-    'filter[mail][condition][path]': 'mail',
-    'filter[mail][condition][operator]': '=',
-    'filter[mail][condition][value]': '%s@andrew.cmu.edu' % andrewId,
-  }
-  endpoint = "%s/jsonapi/user/user?%s" % (secrets['hostname'], urllib.parse.urlencode(get_params))
-  headers = {
-    'Authorization': 'UsersJwt %s' % secrets['jwt_token']
-  }
-  req = urllib.request.Request(endpoint, headers=headers, method='GET')
   try:
-    resp = urllib.request.urlopen(req).read()
-    resp_data = json.loads(resp.decode('utf-8'))
-    return resp_data['data'][0]['id']   # User UUID
-  except IndexError:
+    return resolve_andrewids([andrewId])[andrewId]['uuid']   # User UUID
+  except KeyError:
     raise Exception("No such user %s" % (andrewId))
-  except urllib.error.HTTPError as e:
-    raise Exception("BioRAFT error %s" % (e))
 
-@functools.cache
 def translate_andrewid_to_user_id_number(andrewId):
-  if secrets is None:
-    load_secrets()
-
-  get_params = {
-    'filter[status]': 1,
-    'filter[mail][condition][path]': 'mail',
-    'filter[mail][condition][operator]': '=',
-    'filter[mail][condition][value]': '%s@andrew.cmu.edu' % andrewId,
-  }
-  endpoint = "%s/jsonapi/user/user?%s" % (secrets['hostname'], urllib.parse.urlencode(get_params))
-  headers = {
-    'Authorization': 'UsersJwt %s' % secrets['jwt_token']
-  }
-  req = urllib.request.Request(endpoint, headers=headers, method='GET')
   try:
-    resp = urllib.request.urlopen(req).read()
-    resp_data = json.loads(resp.decode('utf-8'))
-    return resp_data['data'][0]['attributes']['drupal_internal__uid']   # User ID number
-  except IndexError:
+    return resolve_andrewids([andrewId])[andrewId]['uid']   # User ID number
+  except KeyError:
     raise Exception("No such user %s" % (andrewId))
-  except urllib.error.HTTPError as e:
-    raise Exception("BioRAFT error %s" % (e))
 
 # Get a selected training record for a user.
 def get_user_training_record(andrewId, course_id):
@@ -167,12 +237,12 @@ def get_user_training_record(andrewId, course_id):
   }
   endpoint = "%s/jsonapi/raft_training_record/raft_training_record?%s" % (secrets['hostname'], urllib.parse.urlencode(get_params))
   headers = {
-    'Authorization': 'UsersJwt %s' % secrets['jwt_token']
+    'Authorization': 'UsersJwt %s' % authenticate()
   }
 
   req = urllib.request.Request(endpoint, headers=headers, method='GET')
   try:
-    resp = urllib.request.urlopen(req).read()
+    resp = transport.urlopen(req).read()
     resp_data = json.loads(resp.decode('utf-8'))
     # NOTE: There can be more than one entry.
     entry = resp_data['data'][0]
@@ -217,12 +287,12 @@ def get_all_user_trainings(andrewId):
   }
   endpoint = "%s/jsonapi/raft_training_record/raft_training_record?%s" % (secrets['hostname'], urllib.parse.urlencode(get_params))
   headers = {
-    'Authorization': 'UsersJwt %s' % secrets['jwt_token']
+    'Authorization': 'UsersJwt %s' % authenticate()
   }
 
   req = urllib.request.Request(endpoint, headers=headers, method='GET')
   try:
-    resp = urllib.request.urlopen(req).read()
+    resp = transport.urlopen(req).read()
     resp_data = json.loads(resp.decode('utf-8'))
     user_trainings = {}
     for entry in resp_data['data']:
@@ -253,36 +323,85 @@ def get_all_user_trainings_tiered(andrewId):
     'other_trainings': other_trainings
   }
 
-def get_course_title(course_id):
+def get_course_catalog():
+  # Return a dictionary mapping the ID of every (published) training course to
+  # its title, from the cache if it's fresh enough.
+  global course_catalog
+  if course_catalog is None:
+    catalog = cache.get_cache().get('bioraft_courses', 'catalog', cache.get_ttl('bioraft_courses'))
+    if catalog is None:
+      refresh_course_catalog()
+    else:
+      course_catalog = { course_id: title for (course_id, title) in catalog }
+  return course_catalog
+
+def refresh_course_catalog():
+  # Fetch the whole catalog of training courses, page by page, and cache it.
+  global course_catalog, course_catalog_refreshed, missing_courses
   if secrets is None:
     load_secrets()
-  if training_courses is None:
-    load_training_courses()
 
   get_params = {
     'filter[status]': 1,
-    'filter[drupal_internal__nid][condition][path]': 'drupal_internal__nid',
-    'filter[drupal_internal__nid][condition][operator]': '=',
-    'filter[drupal_internal__nid][condition][value]': course_id
+    'fields[node--raft_training_course]': 'drupal_internal__nid,title',
+    'page[offset]': 0,
+    'page[limit]': 50
   }
   endpoint = "%s/jsonapi/node/raft_training_course?%s" % (secrets['hostname'], urllib.parse.urlencode(get_params))
-  headers = {
-    'Authorization': 'UsersJwt %s' % secrets['jwt_token']
-  }
+  catalog = {}
+  while True:
+    headers = {
+      'Authorization': 'UsersJwt %s' % authenticate()
+    }
+    req = urllib.request.Request(endpoint, headers=headers, method='GET')
+    try:
+      resp = transport.urlopen(req).read()
+      resp_data = json.loads(resp.decode('utf-8'))
+      for entry in resp_data['data']:
+        catalog[entry['attributes']['drupal_internal__nid']] = entry['attributes']['title']
+      # Get next endpoint URL
+      endpoint = resp_data['links']['next']['href']
+    except KeyError:  # no next endpoint
+      break
+    except urllib.error.HTTPError as e:
+      raise Exception("BioRAFT error %s" % (e))
 
-  req = urllib.request.Request(endpoint, headers=headers, method='GET')
-  try:
-    resp = urllib.request.urlopen(req).read()
-    resp_data = json.loads(resp.decode('utf-8'))
-  except urllib.error.HTTPError as e:
-    raise Exception("BioRAFT error %s" % (e))
+  cache.get_cache().set('bioraft_courses', 'catalog', sorted(catalog.items()))
+  cache.get_cache().set('bioraft_courses', 'missing', [])
+  course_catalog = catalog
+  course_catalog_refreshed = True
+  missing_courses = set()
+
+def get_missing_courses():
+  # Return the set of IDs of courses which have been looked up but found
+  # missing from the catalog since it was last fetched.
+  global missing_courses
+  if missing_courses is None:
+    missing = cache.get_cache().get('bioraft_courses', 'missing', cache.get_ttl('bioraft_courses'))
+    missing_courses = set(missing or [])
+  return missing_courses
+
+def get_course_title(course_id):
+  if training_courses is None:
+    load_training_courses()
+
+  catalog = get_course_catalog()
+  # A course may have been added since the catalog was cached, so refetch it
+  # (at most once) before giving up on it.  Deprecated courses which we know,
+  # and those already found missing from the catalog, don't warrant this.
+  if course_id not in catalog and course_id not in training_courses and course_id not in get_missing_courses():
+    if not course_catalog_refreshed:
+      refresh_course_catalog()
+      catalog = course_catalog
+    if course_id not in catalog:
+      get_missing_courses().add(course_id)
+      cache.get_cache().set('bioraft_courses', 'missing', sorted(get_missing_courses()))
   try:
-    data = resp_data['data'].pop()
-    return data['attributes']['title']
-  except IndexError:
-    # Unknown or deprecated training courses will result in an IndexError, so
-    # fall back to a default name for the training course unless it's one of
-    # the ones we know.
+    return catalog[course_id]
+  except KeyError:
+    # Unknown or deprecated training courses won't be in the catalog, so fall
+    # back to a default name for the training course unless it's one of the
+    # ones we know.
     if course_id in training_courses:
       return "[DEPRECATED] %s" % training_courses[course_id]['title']
     return "[DEPRECATED] Unknown training %d" % course_id
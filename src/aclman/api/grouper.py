@@ -4,6 +4,7 @@ import base64
 import json
 
 from .. import config_handler
+from . import transport
 
 secrets = None
 
@@ -24,7 +25,7 @@ def get_members(groupId):
   endpoint = "%s/grouper-ws/servicesRest/json/v2_2_001/groups/%s/members" % (secrets['hostname'], urllib.parse.quote_plus(groupId))
   req = urllib.request.Request(endpoint, None, secrets['auth_header'], method='GET')
   try:
-    resp = urllib.request.urlopen(req).read()
+    resp = transport.urlopen(req).read()
     group_data = json.loads(resp.decode('utf-8'))
     try:
       subject_data = group_data['WsGetMembersLiteResult']['wsSubjects']
@@ -46,7 +47,7 @@ def add_member(groupId, member):
   endpoint = "%s/grouper-ws/servicesRest/json/v2_2_001/groups/%s/members/%s" % (secrets['hostname'], urllib.parse.quote_plus(groupId), member)
   req = urllib.request.Request(endpoint, None, secrets['auth_header'], method='PUT')
   try:
-    resp = urllib.request.urlopen(req).read()
+    resp = transport.urlopen(req).read()
   except urllib.error.HTTPError as e:
     raise e
 
@@ -57,10 +58,59 @@ def remove_member(groupId, member):
   endpoint = "%s/grouper-ws/servicesRest/json/v2_2_001/groups/%s/members/%s" % (secrets['hostname'], urllib.parse.quote_plus(groupId), member)
   req = urllib.request.Request(endpoint, None, secrets['auth_header'], method='DELETE')
   try:
-    resp = urllib.request.urlopen(req).read()
+    resp = transport.urlopen(req).read()
   except urllib.error.HTTPError as e:
     raise e
 
+def __update_members(groupId, members, method, request_type, result_type):
+  # Apply a batched membership update, in chunks of at most the configured
+  # batch size, and return a dictionary mapping each of `members` to its
+  # result code, e.g., 'SUCCESS' or 'SUCCESS_ALREADY_EXISTED', or 'NO_RESULT'
+  # if its batch failed outright.
+  if secrets is None:
+    load_secrets()
+
+  members = sorted(set(members))
+  batch_size = config_handler.get_config('grouper_batch_size')
+  endpoint = "%s/grouper-ws/servicesRest/json/v2_2_001/groups/%s/members" % (secrets['hostname'], urllib.parse.quote_plus(groupId))
+  headers = { 'Content-Type': 'text/x-json; charset=UTF-8' }
+  headers.update(secrets['auth_header'])
+
+  results = {}
+  for i in range(0, len(members), batch_size):
+    batch = members[i:i+batch_size]
+    data = { request_type: { 'subjectLookups': [ { 'subjectId': x } for x in batch ] } }
+    req = urllib.request.Request(endpoint, json.dumps(data).encode('utf-8'), headers, method=method)
+    try:
+      resp = transport.urlopen(req).read()
+    except urllib.error.HTTPError as e:
+      # Grouper reports a failure for any subject in the batch as an error for
+      # the request as a whole, but still includes the per-subject results.
+      sys.stderr.write("Grouper error: %s\n" % e)
+      resp = e.read()
+    try:
+      result_data = json.loads(resp.decode('utf-8'))[result_type]['results']
+    except (ValueError, KeyError):
+      result_data = []
+    for result in result_data:
+      results[result['wsSubject']['id']] = result['resultMetadata']['resultCode']
+    # Any subject missing from the results was not processed at all.
+    for x in batch:
+      results.setdefault(x, 'NO_RESULT')
+  return results
+
+def add_members(groupId, members):
+  return __update_members(groupId, members, 'PUT', 'WsRestAddMemberRequest', 'WsAddMemberResults')
+
+def remove_members(groupId, members):
+  return __update_members(groupId, members, 'POST', 'WsRestDeleteMemberRequest', 'WsDeleteMemberResults')
+
+def is_success(result_code):
+  # Whether a per-subject result code from `add_members()` or
+  # `remove_members()` denotes success, including no-ops, e.g.,
+  # 'SUCCESS_ALREADY_EXISTED' or 'SUCCESS_WASNT_IMMEDIATE'.
+  return result_code.startswith('SUCCESS')
+
 def has_member(groupId, member):
   if secrets is None:
     load_secrets()
@@ -68,7 +118,7 @@ def has_member(groupId, member):
   endpoint = "%s/grouper-ws/servicesRest/json/v2_2_001/groups/%s/members/%s" % (secrets['hostname'], urllib.parse.quote_plus(groupId), member)
   req = urllib.request.Request(endpoint, None, secrets['auth_header'], method='GET')
   try:
-    resp = urllib.request.urlopen(req).read()
+    resp = transport.urlopen(req).read()
     member_data = json.loads(resp.decode('utf-8'))
     try:
       subject_data = member_data['WsHasMemberLiteResult']['resultMetadata']['resultCode']
@@ -77,3 +127,32 @@ def has_member(groupId, member):
     return ( subject_data == 'IS_MEMBER' )
   except urllib.error.HTTPError as e:
     raise e
+
+def get_memberships(member, groupIds):
+  # Return the subset of `groupIds` of which `member` is a member, directly or
+  # indirectly, from a single request.
+  if secrets is None:
+    load_secrets()
+
+  groupIds = list(groupIds)
+  if not groupIds:
+    return set()
+  endpoint = "%s/grouper-ws/servicesRest/json/v2_2_001/memberships" % secrets['hostname']
+  headers = { 'Content-Type': 'text/x-json; charset=UTF-8' }
+  headers.update(secrets['auth_header'])
+  data = { 'WsRestGetMembershipsRequest': {
+    'wsSubjectLookups': [ { 'subjectId': member } ],
+    'wsGroupLookups': [ { 'groupName': x } for x in groupIds ],
+    'memberFilter': 'All'
+  } }
+  req = urllib.request.Request(endpoint, json.dumps(data).encode('utf-8'), headers, method='POST')
+  try:
+    resp = transport.urlopen(req).read()
+    membership_data = json.loads(resp.decode('utf-8'))
+    try:
+      group_names = { x['groupName'] for x in membership_data['WsGetMembershipsResults']['wsMemberships'] }
+    except KeyError:
+      group_names = set()
+    return { x for x in groupIds if x in group_names }
+  except urllib.error.HTTPError as e:
+    raise e
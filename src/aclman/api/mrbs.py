@@ -1,50 +1,190 @@
 import datetime
-import subprocess
 import re
 
+import pymysql
+
 from ..models import *
 from .. import config_handler
 from . import s3 as S3
 
 secrets = None
+connection = None
 
 def load_secrets():
   global secrets
   secrets = config_handler.get_secrets('mrbs_db')
   secrets['domain'] = 'andrew.cmu.edu'
 
-def execute(stmt):
+def connect():
+  # Return the persistent connection to the MRBS database, (re)connecting as
+  # needed.  Each batch of writes is applied within its own transaction.
+  global connection
   if secrets is None:
     load_secrets()
 
-  return subprocess.check_output(["mysql", "-h", secrets['hostname'], "-s", "-N", "-u", secrets['username'], "-p%s" % secrets['password'], "-e", stmt]).decode('utf-8')
+  if connection is None:
+    connection = pymysql.connect(host=secrets['hostname'], user=secrets['username'], password=secrets['password'], charset='utf8mb4', autocommit=True)
+  else:
+    connection.ping(reconnect=True)
+  return connection
 
-def get_members(roomId):
-  if secrets is None:
-    load_secrets()
+def close():
+  global connection
+  if connection is not None:
+    connection.close()
+    connection = None
 
-  rows = execute("SELECT user_name FROM mrbs.mrbs_permissions WHERE room_id = \'%d\';" % roomId)
-  return { re.sub('@%s$' % secrets['domain'], '', x) for x in rows.splitlines() }
+def execute(stmt, args=None):
+  with connect().cursor() as cursor:
+    cursor.execute(stmt, args)
+    return cursor.fetchall()
 
-def add_member(roomId, member):
+def get_eppn(member):
   if secrets is None:
     load_secrets()
 
-  # First, determine if the user is in the MRBS database at all.
-  eppn = "%s@%s" % (member, secrets['domain'])
-  count = int( execute("SELECT count(id) FROM mrbs.mrbs_users WHERE user_login = \"%s\";" % eppn) )
-  # Add them if they're not.
-  if count == 0:
-    execute("INSERT INTO mrbs.mrbs_users (user_login, user_pass, user_nicename, user_email, display_name, level, affiliation, user_registered) VALUES (\"%s\", \"%s\", \"%s\", \"%s\", \"%s\", \"1\", \"C\", \"%s\");" % (eppn, member, member, eppn, S3.get_student_from_andrewid(member).fullDisplayName, datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")))
-    # NOTE: `user_pass` is not actually used since MRBS login is controlled
-    # by Shibboleth.
+  return "%s@%s" % (member, secrets['domain'])
 
-  # Now, provide the permission.
-  execute("INSERT INTO mrbs.mrbs_permissions (user_name, room_id) VALUES (\"%s\", \"%d\");" % (eppn, roomId))
+def get_members(roomId):
+  return get_all_members([roomId])[roomId]
 
-def remove_member(roomId, member):
+def get_all_members(roomIds):
+  # Return a dictionary mapping each of `roomIds` to the set of members with
+  # permissions for that room, from a single query.
   if secrets is None:
     load_secrets()
 
-  eppn = "%s@%s" % (member, secrets['domain'])
-  execute("DELETE FROM mrbs.mrbs_permissions WHERE user_name = \"%s\" AND room_id = \"%d\";" % (eppn, roomId))
+  members = { roomId: set() for roomId in roomIds }
+  if not members:
+    return members
+  rows = execute("SELECT room_id, user_name FROM mrbs.mrbs_permissions WHERE room_id IN %s;", (list(members),))
+  for (roomId, user_name) in rows:
+    members[roomId].add(re.sub('@%s$' % secrets['domain'], '', user_name))
+  return members
+
+def get_existing_users(eppns):
+  # Return the subset of `eppns` which are already users in the MRBS
+  # database, from a single query.
+  eppns = list(set(eppns))
+  if not eppns:
+    return set()
+  rows = execute("SELECT user_login FROM mrbs.mrbs_users WHERE user_login IN %s;", (eppns,))
+  return { x for (x,) in rows }
+
+def __insert_members(roomId, rows):
+  # Apply the given (user row, or None if the user exists, and EPPN) pairs in
+  # a single transaction.
+  db = connect()
+  db.begin()
+  try:
+    with db.cursor() as cursor:
+      # First, add the users who aren't in the MRBS database.
+      new_users = [ user for (user, _) in rows if user is not None ]
+      if new_users:
+        cursor.executemany("INSERT INTO mrbs.mrbs_users (user_login, user_pass, user_nicename, user_email, display_name, level, affiliation, user_registered) VALUES (%s, %s, %s, %s, %s, %s, %s, %s);", new_users)
+        # NOTE: `user_pass` is not actually used since MRBS login is controlled
+        # by Shibboleth.
+
+      # Now, provide the permission.
+      cursor.executemany("INSERT INTO mrbs.mrbs_permissions (user_name, room_id) VALUES (%s, %s);", [ (eppn, roomId) for (_, eppn) in rows ])
+    db.commit()
+  except:
+    db.rollback()
+    raise
+
+def add_members(roomId, members, existing_eppns=None):
+  # Provide the permission for `roomId` to all of `members`, first adding any
+  # of them who are not yet in the MRBS database, and return a dictionary
+  # mapping each member to None if successful, or to the exception which
+  # prevented it.  If the set of `existing_eppns` (e.g., from
+  # `get_existing_users()`) is given, it is trusted rather than queried again,
+  # and is updated with any users added.
+  members = sorted(set(members))
+  results = {}
+  if not members:
+    return results
+  eppns = { member: get_eppn(member) for member in members }
+  if existing_eppns is None:
+    known_eppns = get_existing_users(eppns.values())
+  else:
+    known_eppns = existing_eppns
+
+  # Look up the display names of new users before starting any transaction,
+  # skipping any which can't be found.
+  now = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+  rows = {}
+  for member, eppn in eppns.items():
+    if eppn in known_eppns:
+      rows[member] = (None, eppn)
+      continue
+    try:
+      display_name = S3.get_student_from_andrewid(member).fullDisplayName
+    except KeyError:
+      results[member] = Exception("No S3 record for '%s'" % member)
+      continue
+    except Exception as e:
+      results[member] = e
+      continue
+    rows[member] = ((eppn, member, member, eppn, display_name, "1", "C", now), eppn)
+
+  # Apply the whole batch in a single transaction; if that fails, retry each
+  # member in their own, so that one bad row doesn't block the rest.
+  if not rows:
+    return results
+  try:
+    __insert_members(roomId, list(rows.values()))
+    results.update((member, None) for member in rows)
+  except Exception:
+    for member, row in rows.items():
+      try:
+        __insert_members(roomId, [row])
+        results[member] = None
+      except Exception as e:
+        results[member] = e
+  if existing_eppns is not None:
+    existing_eppns.update(eppn for member, (user, eppn) in rows.items() if user is not None and results[member] is None)
+  return results
+
+def add_member(roomId, member):
+  result = add_members(roomId, [member])[member]
+  if result is not None:
+    raise result
+
+def __delete_members(roomId, eppns):
+  db = connect()
+  db.begin()
+  try:
+    with db.cursor() as cursor:
+      cursor.execute("DELETE FROM mrbs.mrbs_permissions WHERE room_id = %s AND user_name IN %s;", (roomId, eppns))
+    db.commit()
+  except:
+    db.rollback()
+    raise
+
+def remove_members(roomId, members):
+  # Revoke the permission for `roomId` from all of `members`, and return a
+  # dictionary mapping each member to None if successful, or to the exception
+  # which prevented it.  As with `add_members()`, the whole batch is applied
+  # in a single transaction if possible, and otherwise one member at a time.
+  members = sorted(set(members))
+  results = {}
+  if not members:
+    return results
+  eppns = { member: get_eppn(member) for member in members }
+
+  try:
+    __delete_members(roomId, list(eppns.values()))
+    results.update((member, None) for member in members)
+  except Exception:
+    for member, eppn in eppns.items():
+      try:
+        __delete_members(roomId, [eppn])
+        results[member] = None
+      except Exception as e:
+        results[member] = e
+  return results
+
+def remove_member(roomId, member):
+  result = remove_members(roomId, [member])[member]
+  if result is not None:
+    raise result
@@ -1,45 +1,85 @@
-import functools
 import sys
 import urllib.request
 import urllib.parse
 import json
 
 from ..models import *
+from .. import cache
 from .. import config_handler
+from .. import concurrency
 from .. import helpers
+from . import transport
 
 secrets = None
 
 students = {}
 student_sections = {}
+section_crosslists = {}
 
 business_semester = helpers.business_semester()
-opener = urllib.request.build_opener(urllib.request.BaseHandler()) # default opener
+# The name of the cache TTL for academic data (see `cache.get_ttl()`).
+academic_ttl = 's3_academic'
+opener = transport.build_opener() # default opener
 
 def load_secrets():
   global secrets, opener
-  secrets = config_handler.get_secrets('s3_api')
+  s3_secrets = config_handler.get_secrets('s3_api')
 
   passman = urllib.request.HTTPPasswordMgrWithDefaultRealm()
-  passman.add_password(None, secrets['hostname'], secrets['username'], secrets['password'])
+  passman.add_password(None, s3_secrets['hostname'], s3_secrets['username'], s3_secrets['password'])
 
   authhandler = urllib.request.HTTPBasicAuthHandler(passman)
-  opener = urllib.request.build_opener(authhandler)
+  opener = transport.build_opener(authhandler)
+  # NOTE: Set `secrets` only once the authenticated opener is ready, since
+  # concurrent workers take `secrets` being set to mean that it is safe to
+  # make requests.
+  secrets = s3_secrets
 
 
 def get_crosslists(section):
   if secrets is None:
     load_secrets()
 
+  # Return memoized copy, if available.
+  if section in section_crosslists:
+    return section_crosslists[section]
+
   endpoint = "%s/course/courses/%s" % (secrets['hostname'], str(section))
   try:
     resp = opener.open(endpoint).read()
     section_data = json.loads(resp.decode('utf-8'))
-    section_crosslists = section_data['crossListedCourses']
+    crosslist_data = section_data['crossListedCourses']
   except urllib.error.HTTPError as e:
     sys.stderr.write("Couldn't find crosslists: SECTION %s DOESN'T EXIST!\n" % section)
-    section_crosslists = []
-  return [ Section(crosslist['semesterCode'], crosslist['courseNumber'], crosslist['section']) for crosslist in section_crosslists ]
+    crosslist_data = []
+  crosslists = [ Section(crosslist['semesterCode'], crosslist['courseNumber'], crosslist['section']) for crosslist in crosslist_data ]
+  __record_crosslist_group(section, crosslists)
+  return section_crosslists[section]
+
+def resolve_crosslists(sections):
+  if secrets is None:
+    load_secrets()
+
+  # Look up the crosslists of many sections concurrently.  Every member of a
+  # crosslist group is crosslisted with every other member, so once any one
+  # member of a group has been looked up, the crosslists of the rest are known
+  # without any further requests.  Lookups are dispatched in rounds of up to
+  # `jobs` sections, skipping any sections resolved in earlier rounds.
+  pending = [ section for section in dict.fromkeys(sections) if section not in section_crosslists ]
+  while len(pending) > 0:
+    batch = pending[:concurrency.get_jobs()]
+    concurrency.map_ordered(get_crosslists, batch)
+    pending = [ section for section in pending[len(batch):] if section not in section_crosslists ]
+  return { section: section_crosslists[section] for section in sections }
+
+def __record_crosslist_group(section, crosslists):
+  # Memoize the crosslists of `section` as returned by S3, and derive the
+  # crosslists of each other member of its group from them.
+  section_crosslists[section] = crosslists
+  group = list(dict.fromkeys([section] + crosslists))
+  for member in group:
+    if member not in section_crosslists:
+      section_crosslists[member] = [ x for x in group if x != member ]
 
 def get_roster_bioUrls(section):
   if secrets is None:
@@ -83,39 +123,99 @@ def get_student_from_bioid(bioId):
   if secrets is None:
     load_secrets()
 
-  andrewId = __translate_bioid_to_andrewid(bioId)
-  get_student_from_andrewid(andrewId)
+  biographical = __get_biographical_data_from_bioid(bioId)
+  if biographical is None:
+    return None
+  andrewId = biographical['andrewId']
+  # The biographical record for the BIO ID carries everything needed to build
+  # the student, so build it directly from that record rather than refetching
+  # it by Andrew ID.
+  if andrewId not in students:
+    __fetch_student_data_from_andrewid(andrewId, biographical)
   # Fill in the missing `bioID` value, since it is known.
   students[andrewId].set_bioId(bioId)
   return students[andrewId]
 
-@functools.cache
-def __translate_bioid_to_andrewid(bioId):
+def get_students_from_bioids(bioIds):
   if secrets is None:
     load_secrets()
 
-  endpoint = "%s/student/bio/%s?idType=BIO" % (secrets['hostname'], bioId)
-  bio_response = opener.open(endpoint).read()
-  try:
-    bio_data = json.loads(bio_response.decode('utf-8'))
-  except:
-    # HTTP 200 with blank response implies that no student record exists.
-    return None
-  return bio_data['andrewId']
+  # Hydrate many students at once.  This is equivalent to calling
+  # `get_student_from_bioid()` for each BIO ID in turn, but runs the
+  # biographical lookups for all students concurrently, followed by the
+  # academic lookups for all students and semesters concurrently.  Results are
+  # returned as a dictionary keyed by BIO ID, with None for any BIO ID without
+  # a student record.
+  bioIds = list(bioIds)
+  all_biographical = concurrency.map_ordered(__get_biographical_data_from_bioid, bioIds)
+
+  new_biographical = {}
+  for biographical in all_biographical:
+    if biographical is not None and biographical['andrewId'] not in students:
+      new_biographical[biographical['andrewId']] = biographical
+  query_semesters = __query_semesters()
+  queries = [ (andrewId, semester) for andrewId in new_biographical for semester in query_semesters ]
+  all_semester_data = concurrency.map_ordered(lambda query: __get_academic_data(*query), queries)
 
-def __fetch_student_data_from_andrewid(andrewId):
-  global students
+  # Assemble the students serially, in order, just as they would have been
+  # assembled one at a time.
+  semester_data = {}
+  for (andrewId, semester), academic in zip(queries, all_semester_data):
+    semester_data.setdefault(andrewId, {})[str(semester)] = academic
+  for andrewId, biographical in new_biographical.items():
+    students[andrewId] = __build_student(biographical, semester_data[andrewId])
+
+  hydrated_students = {}
+  for bioId, biographical in zip(bioIds, all_biographical):
+    if biographical is None:
+      hydrated_students[bioId] = None
+      continue
+    hydrated_students[bioId] = students[biographical['andrewId']]
+    # Fill in the missing `bioID` value, since it is known.
+    hydrated_students[bioId].set_bioId(bioId)
+  return hydrated_students
+
+def __get_biographical_data_from_bioid(bioId):
   if secrets is None:
     load_secrets()
 
-  data = {}
+  student_cache = cache.get_cache()
+
+  # If this BIO ID has been seen recently, its Andrew ID is already known.
+  andrewId = student_cache.get('s3_bioid', bioId, cache.get_ttl('s3_biographical'))
+  if andrewId is not None:
+    if andrewId in students:
+      return students[andrewId].data['biographical']
+    return __get_biographical_data(andrewId)
+
+  biographical = __fetch_biographical_data(bioId, 'BIO')
+  if biographical is None:
+    return None
+  student_cache.set('s3_bioid', bioId, biographical['andrewId'])
+  student_cache.set('s3_biographical', biographical['andrewId'], biographical)
+  return biographical
+
+def __get_biographical_data(andrewId):
+  # Get biographical data for the student from the persistent cache if it is
+  # fresh enough, or from S3 otherwise.
+  student_cache = cache.get_cache()
+  biographical = student_cache.get('s3_biographical', andrewId, cache.get_ttl('s3_biographical'))
+  if biographical is None:
+    biographical = __fetch_biographical_data(andrewId, 'ANDREW')
+    if biographical is None:
+      return None
+    student_cache.set('s3_biographical', andrewId, biographical)
+  return biographical
+
+def __fetch_biographical_data(studentId, idType):
+  if secrets is None:
+    load_secrets()
 
-  # Get biographical data for the student.
-  endpoint = "%s/student/bio/%s?idType=ANDREW" % (secrets['hostname'], andrewId)
+  endpoint = "%s/student/bio/%s?idType=%s" % (secrets['hostname'], studentId, idType)
   bio_response = opener.open(endpoint).read()
   try:
     bio_data = json.loads(bio_response.decode('utf-8'))
-    data['biographical'] = {
+    return {
       'andrewId': bio_data['andrewId'],
       'bioId': bio_data['bioId'],
       'cardId': bio_data['cardId'],
@@ -127,49 +227,84 @@ def __fetch_student_data_from_andrewid(andrewId):
     # HTTP 200 with blank response implies that no student record exists.
     return None
 
+def __query_semesters():
   # Get academic data for the student for the current business semester.  If
   # it's summer, query both sessions (M and N) as well as the following fall.
-  data['academic'] = {}
-  billable = False
   if business_semester.sem_type == 'U':
     year_code = business_semester.year_code
-    query_semesters = [Semester('M%s' % year_code), Semester('N%s' % year_code), Semester('F%s' % year_code)]
+    return [Semester('M%s' % year_code), Semester('N%s' % year_code), Semester('F%s' % year_code)]
   else:
-    query_semesters = [business_semester]
+    return [business_semester]
+
+def __get_academic_data(andrewId, semester):
+  if secrets is None:
+    load_secrets()
+
   # NOTE: The `enrollmentStatusFlag` provided by the API is 'Y' if the
   # student's enrollment status code is any of:
   # - E1: Enrolled
   # - R1: Conditionally Enrolled
   # - R3: Eligible to Enroll
-  for semester in query_semesters:
+  #
+  # Academic data is cached separately for each semester, so that it is
+  # naturally refetched once the business semester changes.
+  student_cache = cache.get_cache()
+  cache_key = "%s:%s" % (andrewId, semester)
+  academic = student_cache.get('s3_academic', cache_key, cache.get_ttl(academic_ttl))
+  if academic is None:
     endpoint = "%s/student/academic/%s?idType=ANDREW&semesterCode=%s" % (secrets['hostname'], andrewId, semester)
     academic_response = opener.open(endpoint).read()
     try:
       academic_data = json.loads(academic_response.decode('utf-8'))
-      data['academic'][str(semester)] = {
+      academic = {
         'enrolled': (academic_data['enrollmentStatusFlag'] == 'Y'),
         'graduationSemester': academic_data['graduationSemesterCode']
       }
     except:
       # HTTP 200 with blank response implies that a student record exists, but
       # has no academic record for the specified semester.
-      data['academic'][str(semester)] = {
+      academic = {
         'enrolled': False,
         'graduationSemester': None
       }
+    student_cache.set('s3_academic', cache_key, academic)
+  return academic
+
+def __fetch_student_data_from_andrewid(andrewId, biographical=None):
+  if secrets is None:
+    load_secrets()
+
+  # Get biographical data for the student, unless it was already provided.
+  if biographical is None:
+    biographical = __get_biographical_data(andrewId)
+    if biographical is None:
+      return None
+
+  semester_data = { str(semester): __get_academic_data(andrewId, semester) for semester in __query_semesters() }
+
+  # Persist the data for this student to the global cache before returning it.
+  students[andrewId] = __build_student(biographical, semester_data)
+  return students[andrewId]
+
+def __build_student(biographical, semester_data):
+  data = {}
+  data['biographical'] = biographical
+
+  data['academic'] = {}
+  billable = False
+  for semester, academic in semester_data.items():
+    data['academic'][semester] = academic
     # A student is considered billable if they are enrolled in any of the
-    # `query_semesters`.
-    billable = billable or data['academic'][str(semester)]['enrolled']
+    # queried semesters.
+    billable = billable or academic['enrolled']
   data['academic']['billable'] = billable
   # A student is considered a pending graduate, for our purposes, if the most
   # recent/current graduation semester code is equivalent to the current
   # semester.
-  grad_semester = data['academic'][str(query_semesters[-1])]['graduationSemester']
+  grad_semester = data['academic'][list(semester_data)[-1]]['graduationSemester']
   if grad_semester is None:
     data['academic']['pendingGraduate'] = False
   else:
     data['academic']['pendingGraduate'] = ( Semester(grad_semester) == business_semester )
 
-  # Persist the data for this student to the global cache before returning it.
-  students[andrewId] = Student(data)
-  return students[andrewId]
+  return Student(data)
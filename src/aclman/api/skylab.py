@@ -6,6 +6,8 @@ import json
 
 from ..models import *
 from .. import config_handler
+from .. import concurrency
+from . import transport
 from . import s3 as S3
 
 secrets = None
@@ -46,10 +48,11 @@ def get_user_data(andrewId):
   }
   req = urllib.request.Request(endpoint, data=json.dumps(parameters).encode(), headers=headers, method='GET')
   try:
-    resp = urllib.request.urlopen(req).read()
+    resp = transport.urlopen(req).read()
     resp_data = json.loads(resp.decode('utf-8'))
     return resp_data['payload'][0]
   except urllib.error.HTTPError as e:
+    error = json.loads(e.read().decode())
     raise Exception("Skylab error %s: %s\n%s" % (error['errorCode'], error['errorMsg'], error['errorDetails']))
 
 def add_user(andrewId):
@@ -72,7 +75,7 @@ def add_user(andrewId):
   }
   req = urllib.request.Request(endpoint, data=json.dumps(params).encode(), headers=headers, method='POST')
   try:
-    resp = urllib.request.urlopen(req).read()
+    resp = transport.urlopen(req).read()
     resp_data = json.loads(resp.decode('utf-8'))
   except urllib.error.HTTPError as e:
     error = json.loads(e.read().decode())
@@ -93,7 +96,7 @@ def enable_user(andrewId):
   }
   req = urllib.request.Request(endpoint, data=json.dumps(params).encode(), headers=headers, method='POST')
   try:
-    resp = urllib.request.urlopen(req).read()
+    resp = transport.urlopen(req).read()
     resp_data = json.loads(resp.decode('utf-8'))
   except urllib.error.HTTPError as e:
     error = json.loads(e.read().decode())
@@ -113,7 +116,7 @@ def disable_user(andrewId):
   }
   req = urllib.request.Request(endpoint, data=json.dumps(params).encode(), headers=headers, method='POST')
   try:
-    resp = urllib.request.urlopen(req).read()
+    resp = transport.urlopen(req).read()
     resp_data = json.loads(resp.decode('utf-8'))
   except urllib.error.HTTPError as e:
     error = json.loads(e.read().decode())
@@ -124,33 +127,34 @@ def __search_users(search_parameters):
   if secrets is None:
     load_secrets()
 
-  num_remaining = __count_users(search_parameters)
-  page_size = 100
-  page_num = 0
-  users = []
-  while num_remaining > 0:
-    page_num += 1
-    num_remaining -= min(num_remaining, page_size)
-    parameters = {
-      'pageSize': page_size,
-      'pageNumber': page_num,
-      'sortBy': '_email',
-      'order': 'ASC'
-    }
-    parameters.update(search_parameters)
-    endpoint = "%s/api/entities/academics-list?%s" % (secrets['hostname'], urllib.parse.urlencode(parameters))
-    headers = {
-      'Content-Type': 'application/json',
-      'api_key': secrets['api_key']
-    }
-    req = urllib.request.Request(endpoint, data=json.dumps(parameters).encode(), headers=headers, method='GET')
-    try:
-      resp = urllib.request.urlopen(req).read()
-      resp_data = json.loads(resp.decode('utf-8'))
-      users.extend([ user['email'] for user in resp_data['payload'] ])
-    except urllib.error.HTTPError as e:
-      raise Exception("Skylab error %s: %s\n%s" % (error['errorCode'], error['errorMsg'], error['errorDetails']))
-  return users
+  # Since the total is known up front, fetch every page concurrently.
+  num_users = __count_users(search_parameters)
+  page_size = config_handler.get_config('skylab_page_size')
+  num_pages = -(-num_users // page_size)
+  pages = concurrency.map_ordered(lambda page_num: __get_users_page(search_parameters, page_size, page_num), range(1, num_pages + 1))
+  return [ email for page in pages for email in page ]
+
+def __get_users_page(search_parameters, page_size, page_num):
+  parameters = {
+    'pageSize': page_size,
+    'pageNumber': page_num,
+    'sortBy': '_email',
+    'order': 'ASC'
+  }
+  parameters.update(search_parameters)
+  endpoint = "%s/api/entities/academics-list?%s" % (secrets['hostname'], urllib.parse.urlencode(parameters))
+  headers = {
+    'Content-Type': 'application/json',
+    'api_key': secrets['api_key']
+  }
+  req = urllib.request.Request(endpoint, data=json.dumps(parameters).encode(), headers=headers, method='GET')
+  try:
+    resp = transport.urlopen(req).read()
+    resp_data = json.loads(resp.decode('utf-8'))
+    return [ user['email'] for user in resp_data['payload'] ]
+  except urllib.error.HTTPError as e:
+    error = json.loads(e.read().decode())
+    raise Exception("Skylab error %s: %s\n%s" % (error['errorCode'], error['errorMsg'], error['errorDetails']))
 
 def __count_users(search_parameters):
   if secrets is None:
@@ -164,8 +168,9 @@ def __count_users(search_parameters):
   }
   req = urllib.request.Request(endpoint, data=json.dumps(parameters).encode(), headers=headers, method='GET')
   try:
-    resp = urllib.request.urlopen(req).read()
+    resp = transport.urlopen(req).read()
     resp_data = json.loads(resp.decode('utf-8'))
     return resp_data['payload']
   except urllib.error.HTTPError as e:
+    error = json.loads(e.read().decode())
     raise Exception("Skylab error %s: %s\n%s" % (error['errorCode'], error['errorMsg'], error['errorDetails']))
@@ -0,0 +1,134 @@
+import io
+import socket
+import threading
+import http.client
+import urllib.request
+import urllib.response
+import urllib.error
+
+# A keep-alive HTTP(S) transport for `urllib.request`.
+#
+# By default, `urllib.request` opens a new connection (and, for HTTPS, a new
+# TLS session) for every request and closes it afterwards.  The handlers here
+# instead keep idle connections in a pool shared by every opener built by this
+# module, keyed by host, and reuse them for subsequent requests to the same
+# host.  Since they are ordinary `urllib.request` handlers, openers built with
+# them keep the usual behavior of any other handlers, e.g., authentication and
+# error handlers.
+#
+# NOTE: Response bodies are read in full before the response is returned, so
+# that the connection can be returned to the pool right away.  Callers read
+# them exactly as before.
+
+
+# Requests which may safely be sent again if their connection fails.
+idempotent_methods = frozenset(('GET', 'HEAD', 'PUT', 'DELETE', 'OPTIONS', 'TRACE'))
+
+
+class ConnectionPool:
+  def __init__(self):
+    self.lock = threading.Lock()
+    self.idle = {}
+
+  def acquire(self, key):
+    with self.lock:
+      connections = self.idle.get(key)
+      if connections:
+        return connections.pop()
+    return None
+
+  def release(self, key, connection):
+    with self.lock:
+      self.idle.setdefault(key, []).append(connection)
+
+  def close_all(self):
+    with self.lock:
+      for connections in self.idle.values():
+        for connection in connections:
+          connection.close()
+      self.idle = {}
+
+pool = ConnectionPool()
+
+
+class KeepAliveHandlerMixin:
+  def keep_alive_open(self, http_class, req, **http_conn_args):
+    host = req.host
+    if not host:
+      raise urllib.error.URLError('no host given')
+    # Don't pool tunneled (i.e., proxied) connections.
+    if req._tunnel_host:
+      return self.do_open(http_class, req, **http_conn_args)
+
+    headers = dict(req.unredirected_hdrs)
+    headers.update({ k: v for k, v in req.headers.items() if k not in headers })
+    headers['Connection'] = 'keep-alive'
+    headers = { name.title(): val for name, val in headers.items() }
+
+    method = req.get_method()
+    key = (http_class, host)
+    connection = pool.acquire(key)
+    reused = connection is not None
+    while True:
+      if connection is None:
+        connection = http_class(host, timeout=req.timeout, **http_conn_args)
+        connection.set_debuglevel(self._debuglevel)
+      responded = False
+      try:
+        connection.request(method, req.selector, req.data, headers, encode_chunked=req.has_header('Transfer-encoding'))
+        resp = connection.getresponse()
+        responded = True
+        body = resp.read()
+        break
+      except socket.timeout as e:
+        connection.close()
+        raise urllib.error.URLError(e)
+      except (OSError, http.client.ImproperConnectionState, http.client.BadStatusLine) as e:
+        connection.close()
+        # A pooled connection may have since been closed by the server, so
+        # retry once on a fresh connection.  Unless the request is idempotent,
+        # only do so if no response had begun, since otherwise the server may
+        # have already acted on it (e.g., a POST creating records).
+        if reused and (method in idempotent_methods or not responded):
+          connection = None
+          reused = False
+          continue
+        if isinstance(e, OSError):
+          raise urllib.error.URLError(e)
+        raise
+      except:
+        connection.close()
+        raise
+
+    if resp.will_close:
+      connection.close()
+    else:
+      pool.release(key, connection)
+
+    response = urllib.response.addinfourl(io.BytesIO(body), resp.msg, req.get_full_url(), resp.status)
+    response.msg = resp.reason
+    return response
+
+class KeepAliveHTTPHandler(KeepAliveHandlerMixin, urllib.request.HTTPHandler):
+  def http_open(self, req):
+    return self.keep_alive_open(http.client.HTTPConnection, req)
+
+class KeepAliveHTTPSHandler(KeepAliveHandlerMixin, urllib.request.HTTPSHandler):
+  def https_open(self, req):
+    return self.keep_alive_open(http.client.HTTPSConnection, req, context=self._context)
+
+
+def build_opener(*handlers):
+  # Build an opener, like `urllib.request.build_opener()`, which uses pooled
+  # keep-alive connections.
+  return urllib.request.build_opener(KeepAliveHTTPHandler, KeepAliveHTTPSHandler, *handlers)
+
+opener = build_opener() # default opener
+
+def install_opener(new_opener):
+  global opener
+  opener = new_opener
+  urllib.request.install_opener(new_opener)
+
+def urlopen(req):
+  return opener.open(req)
@@ -6,6 +6,8 @@ import json
 
 from ..models import *
 from .. import config_handler
+from .. import tokens
+from . import transport
 from . import s3 as S3
 
 secrets = None
@@ -21,21 +23,26 @@ def load_secrets():
   secrets['user_view'] = "All_Users"
 
 def authenticate():
+  # Get a (temporary) access token, reusing a stored one until shortly before
+  # it expires.
   if secrets is None:
     load_secrets()
 
-  # Use the (permanent) refresh token to get a (temporary) access token for
-  # this run; it will be valid for one hour.
+  secrets['oauth_token'] = tokens.get_token("zoho:%s" % secrets['client_id'], __fetch_access_token)
+  return secrets['oauth_token']
+
+def __fetch_access_token():
+  # Use the (permanent) refresh token to get a (temporary) access token; it
+  # will be valid for one hour.
   # https://www.zoho.com/creator/help/api/v2/refresh-the-access-token.html
   endpoint = "%s/oauth/v2/token?client_id=%s&client_secret=%s&refresh_token=%s&grant_type=refresh_token" % (secrets['oauth_host'], secrets['client_id'], secrets['client_secret'], secrets['refresh_token'])
   req = urllib.request.Request(endpoint, data=None, method='POST')
   try:
-    resp = urllib.request.urlopen(req).read()
+    resp = transport.urlopen(req).read()
     resp_data = json.loads(resp.decode('utf-8'))
     if 'error' in resp_data:
       raise Exception("Zoho API error '%s'" % resp_data['error'])
-    secrets['oauth_token'] = resp_data['access_token']
-    expiration_time = datetime.datetime.now() + datetime.timedelta(seconds=resp_data['expires_in'])
+    return (resp_data['access_token'], resp_data['expires_in'])
   except urllib.error.HTTPError as e:
     raise e
 
@@ -56,11 +63,11 @@ def get_users():
     }
     endpoint = "%s/api/v2/%s/%s/report/%s?%s" % (secrets['hostname'], secrets['owner'], secrets['application'], secrets['user_view'], urllib.parse.urlencode(get_params))
     headers = {
-      'Authorization': 'Zoho-oauthtoken %s' % secrets['oauth_token']
+      'Authorization': 'Zoho-oauthtoken %s' % authenticate()
     }
     req = urllib.request.Request(endpoint, data=None, headers=headers, method='GET')
     try:
-      resp = urllib.request.urlopen(req).read()
+      resp = transport.urlopen(req).read()
       resp_data = json.loads(resp.decode('utf-8'))
       num_received = len(resp_data['data'])
       user_data.extend(resp_data['data'])
@@ -80,11 +87,11 @@ def get_user_data(andrewId):
   }
   endpoint = "%s/api/v2/%s/%s/report/%s?%s" % (secrets['hostname'], secrets['owner'], secrets['application'], secrets['user_view'], urllib.parse.urlencode(get_params))
   headers = {
-    'Authorization': 'Zoho-oauthtoken %s' % secrets['oauth_token']
+    'Authorization': 'Zoho-oauthtoken %s' % authenticate()
   }
   req = urllib.request.Request(endpoint, data=None, headers=headers, method='GET')
   try:
-    resp = urllib.request.urlopen(req).read()
+    resp = transport.urlopen(req).read()
     resp_data = json.loads(resp.decode('utf-8'))
     return resp_data['data'][0]
   except IndexError:
@@ -92,94 +99,118 @@ def get_user_data(andrewId):
   except urllib.error.HTTPError as e:
     raise e
 
-def add_user(andrewId):
-  if secrets is None:
-    load_secrets()
+# Zoho's code for a successful operation on a record.
+# https://www.zoho.com/creator/help/api/v2/status-codes.html
+SUCCESS = 3000
 
-  endpoint = "%s/api/v2/%s/%s/form/%s" % (secrets['hostname'], secrets['owner'], secrets['application'], secrets['user_form'])
-  student = S3.get_student_from_andrewid(andrewId)
-  params = { 'data': {
-    'user_aid': andrewId,
-    'user_email': "%s@andrew.cmu.edu" % andrewId,
-    'user_first': student.commonName,
-    'user_last': student.lastName,
-    'user_role': "Student",
-    'user_status': "Active Enrollment",
-    'user_notes': "Added via ACLMAN, %s." % datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-  } }
-  headers = {
-    'Content-Type': 'application/json',
-    'Authorization': 'Zoho-oauthtoken %s' % secrets['oauth_token']
-  }
-  req = urllib.request.Request(endpoint, data=json.dumps(params).encode(), headers=headers, method='POST')
-  try:
-    resp = urllib.request.urlopen(req).read()
-    resp_data = json.loads(resp.decode('utf-8'))
-    # NOTE: Zoho validates whether this would create a duplicate and throws an
-    # error if so.
-    if resp_data['code'] != 3000: # Data Added Successfully
-      raise Exception("Zoho error code %d: '%s'" % (resp_data['code'], resp_data['error']))
-  except urllib.error.HTTPError as e:
-    raise e
+# Maximum number of records added or updated in a single request.
+batch_size = 200
+
+def __get_results(resp_data, count):
+  # Return the list of per-record (code, message) results from a response for
+  # `count` records.
+  if 'result' not in resp_data:
+    return [ (resp_data['code'], resp_data.get('message', resp_data.get('error'))) ] * count
+  return [ (x['code'], x.get('message', x.get('error'))) for x in resp_data['result'] ]
 
-def activate_user(andrewId):
+def add_users(andrewIds):
+  # Add all of `andrewIds` as new users with multi-record form submissions,
+  # and return a dictionary mapping each to its (code, message) result.
   if secrets is None:
     load_secrets()
 
-  try:
-    user_data = get_user_data(andrewId)
-  except:
-    # If the user doesn't exist, create them instead.
-    add_user(andrewId)
-    return
-  # Don't bother if they're already active.
-  if re.search("Active", user_data['user_status']) is not None:
-    return
-  endpoint = "%s/api/v2/%s/%s/report/%s" % (secrets['hostname'], secrets['owner'], secrets['application'], secrets['user_view'])
-  params = {
-    'criteria': 'user_aid == "%s"' % andrewId,
-    'data': {
-      'user_status': "Active Enrollment",
-      'user_notes': "%s\nActivated via ACLMAN, %s." % (user_data['user_notes'], datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
-    }
-  }
+  endpoint = "%s/api/v2/%s/%s/form/%s" % (secrets['hostname'], secrets['owner'], secrets['application'], secrets['user_form'])
   headers = {
     'Content-Type': 'application/json',
-    'Authorization': 'Zoho-oauthtoken %s' % secrets['oauth_token']
+    'Authorization': 'Zoho-oauthtoken %s' % authenticate()
   }
-  req = urllib.request.Request(endpoint, data=json.dumps(params).encode(), headers=headers, method='PATCH')
-  try:
-    resp = urllib.request.urlopen(req).read()
-    resp_data = json.loads(resp.decode('utf-8'))
-  except urllib.error.HTTPError as e:
-    raise e
-
-def deactivate_user(andrewId):
+  notes = "Added via ACLMAN, %s." % datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+  results = {}
+  # Look up each user's name first, skipping any which can't be found.
+  students = {}
+  for andrewId in sorted(set(andrewIds)):
+    try:
+      students[andrewId] = S3.get_student_from_andrewid(andrewId)
+    except KeyError:
+      results[andrewId] = (None, "No S3 record for '%s'" % andrewId)
+    except Exception as e:
+      results[andrewId] = (None, e)
+  andrewIds = list(students)
+  for i in range(0, len(andrewIds), batch_size):
+    batch = andrewIds[i:i+batch_size]
+    records = []
+    for andrewId in batch:
+      student = students[andrewId]
+      records.append({
+        'user_aid': andrewId,
+        'user_email': "%s@andrew.cmu.edu" % andrewId,
+        'user_first': student.commonName,
+        'user_last': student.lastName,
+        'user_role': "Student",
+        'user_status': "Active Enrollment",
+        'user_notes': notes
+      })
+    req = urllib.request.Request(endpoint, data=json.dumps({ 'data': records }).encode(), headers=headers, method='POST')
+    try:
+      resp = transport.urlopen(req).read()
+      resp_data = json.loads(resp.decode('utf-8'))
+    except urllib.error.HTTPError as e:
+      raise e
+    # NOTE: Zoho validates whether each record would create a duplicate and
+    # reports an error for it if so.  Results are in the order submitted.
+    results.update(zip(batch, __get_results(resp_data, len(batch))))
+  return results
+
+def __update_users(users, status):
+  # Set the status of all of the given `users`, as records from `get_users()`,
+  # and return a dictionary mapping each Andrew ID to its (code, message)
+  # result.  Users are updated in batches, selected by record ID.
+  # NOTE: Each user's notes would have to be updated individually, so status
+  # changes are no longer noted there; they are recorded in ACLMAN's log.
   if secrets is None:
     load_secrets()
 
-  try:
-    user_data = get_user_data(andrewId)
-  except:
-    raise Exception("Zoho error: No such user '%s'." % andrewId)
-  # Don't bother if they're already inactive.
-  if re.search("Inactive", user_data['user_status']) is not None:
-    return
   endpoint = "%s/api/v2/%s/%s/report/%s" % (secrets['hostname'], secrets['owner'], secrets['application'], secrets['user_view'])
-  params = {
-    'criteria': 'user_aid == "%s"' % andrewId,
-    'data': {
-      'user_status': "Inactive",
-      'user_notes': "%s\nDeactivated via ACLMAN, %s." % (user_data['user_notes'], datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
-    }
-  }
   headers = {
     'Content-Type': 'application/json',
-    'Authorization': 'Zoho-oauthtoken %s' % secrets['oauth_token']
+    'Authorization': 'Zoho-oauthtoken %s' % authenticate()
   }
-  req = urllib.request.Request(endpoint, data=json.dumps(params).encode(), headers=headers, method='PATCH')
-  try:
-    resp = urllib.request.urlopen(req).read()
-    resp_data = json.loads(resp.decode('utf-8'))
-  except urllib.error.HTTPError as e:
-    raise e
+  users = sorted(users, key=lambda x: x['user_aid'])
+  results = {}
+  for i in range(0, len(users), batch_size):
+    batch = users[i:i+batch_size]
+    params = {
+      'criteria': " || ".join('ID == %s' % x['ID'] for x in batch),
+      'data': {
+        'user_status': status
+      }
+    }
+    req = urllib.request.Request(endpoint, data=json.dumps(params).encode(), headers=headers, method='PATCH')
+    try:
+      resp = transport.urlopen(req).read()
+      resp_data = json.loads(resp.decode('utf-8'))
+    except urllib.error.HTTPError as e:
+      raise e
+    # Match results to users by record ID, since records matching the
+    # criteria may be updated in any order.
+    if 'result' in resp_data:
+      by_id = { str(x['data']['ID']): x for x in resp_data['result'] if 'data' in x }
+      for user in batch:
+        x = by_id.get(str(user['ID']))
+        if x is None:
+          results[user['user_aid']] = (None, "No result for record")
+        else:
+          results[user['user_aid']] = (x['code'], x.get('message', x.get('error')))
+    else:
+      results.update((x['user_aid'], y) for x, y in zip(batch, __get_results(resp_data, len(batch))))
+  return results
+
+def activate_users(users):
+  # Activate all of the given `users`, as records from `get_users()`, which
+  # aren't already active.
+  return __update_users([ x for x in users if re.search("Active", x['user_status']) is None ], "Active Enrollment")
+
+def deactivate_users(users):
+  # Deactivate all of the given `users`, as records from `get_users()`, which
+  # aren't already inactive.
+  return __update_users([ x for x in users if re.search("Inactive", x['user_status']) is None ], "Inactive")
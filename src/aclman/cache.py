@@ -0,0 +1,76 @@
+import pathlib
+import sqlite3
+import threading
+import time
+import json
+
+from . import config_handler
+
+
+# A persistent, on-disk cache of JSON-serializable values, shared by every
+# ACLMAN process invoked from the same directory (e.g., nightly runs and
+# `aclman.user_check`).  Values are grouped into namespaces, and each is
+# considered fresh until it is older than the TTL given when reading it.
+
+# When set, cached values are never considered fresh, so everything is
+# refetched (and the cache is updated with the fresh values).
+refresh = False
+
+shared_cache = None
+shared_cache_lock = threading.Lock()
+
+
+class Cache:
+  def __init__(self, path):
+    self.path = pathlib.Path(path)
+    self.path.parent.mkdir(parents=True, exist_ok=True)
+    # NOTE: A single connection is shared by all threads, serialized by a lock.
+    self.lock = threading.Lock()
+    self.connection = sqlite3.connect(str(self.path), timeout=30, check_same_thread=False)
+    with self.lock, self.connection:
+      self.connection.execute("PRAGMA journal_mode=WAL")
+      self.connection.execute("CREATE TABLE IF NOT EXISTS cache (namespace TEXT NOT NULL, key TEXT NOT NULL, value TEXT NOT NULL, updated REAL NOT NULL, PRIMARY KEY (namespace, key))")
+
+  def get(self, namespace, key, ttl=None):
+    # Return the cached value, or None if it is missing, stale, or a refresh
+    # was requested.
+    if refresh:
+      return None
+    with self.lock:
+      row = self.connection.execute("SELECT value, updated FROM cache WHERE namespace = ? AND key = ?", (namespace, str(key))).fetchone()
+    if row is None:
+      return None
+    (value, updated) = row
+    if ttl is not None and time.time() - updated > ttl:
+      return None
+    return json.loads(value)
+
+  def set(self, namespace, key, value):
+    with self.lock, self.connection:
+      self.connection.execute("INSERT OR REPLACE INTO cache (namespace, key, value, updated) VALUES (?, ?, ?, ?)", (namespace, str(key), json.dumps(value), time.time()))
+
+  def delete(self, namespace, key):
+    with self.lock, self.connection:
+      self.connection.execute("DELETE FROM cache WHERE namespace = ? AND key = ?", (namespace, str(key)))
+
+  def prune(self, max_age):
+    # Delete every value older than `max_age` seconds.
+    with self.lock, self.connection:
+      self.connection.execute("DELETE FROM cache WHERE updated < ?", (time.time() - max_age,))
+
+
+def get_cache():
+  global shared_cache
+
+  # The cache may first be needed from within worker threads, so only one of
+  # them creates it.
+  with shared_cache_lock:
+    if shared_cache is None:
+      cache_dir = config_handler.get_config('output_dirs.cache')
+      shared_cache = Cache(pathlib.Path(config_handler.cwd, cache_dir, 'cache.sqlite').resolve())
+      # No value older than the longest TTL can be fresh, so drop them.
+      shared_cache.prune(max(config_handler.get_config('cache_ttl').values()))
+  return shared_cache
+
+def get_ttl(name):
+  return config_handler.get_config('cache_ttl.%s' % name)
@@ -0,0 +1,40 @@
+import concurrent.futures
+
+from . import config_handler
+
+
+# Number of worker threads used for concurrent network-bound stages.  This is
+# read from the `jobs` configuration key unless overridden, e.g., by the
+# `--jobs` command-line option.
+jobs = None
+
+
+def set_jobs(n=None):
+  global jobs
+
+  if n is None:
+    n = config_handler.get_config('jobs')
+  n = int(n)
+  if n < 1:
+    raise ValueError("Number of jobs must be at least 1, not %d" % n)
+  jobs = n
+
+def get_jobs():
+  if jobs is None:
+    set_jobs()
+  return jobs
+
+
+def map_ordered(fn, items, jobs=None):
+  # Apply `fn` to each of `items` using a bounded pool of worker threads, and
+  # return the results as a list in the same order as `items`, so that callers
+  # may process them exactly as they would have in a serial loop.  Any
+  # exception raised by `fn` is re-raised here.
+  if jobs is None:
+    jobs = get_jobs()
+  items = list(items)
+  if jobs == 1 or len(items) <= 1:
+    return [ fn(item) for item in items ]
+
+  with concurrent.futures.ThreadPoolExecutor(max_workers=min(jobs, len(items))) as executor:
+    return list(executor.map(fn, items))
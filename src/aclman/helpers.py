@@ -1,4 +1,5 @@
 import functools
+import io
 import os
 import errno
 import datetime
@@ -84,4 +85,6 @@ class CustomHTTPErrorHandler(urllib.request.HTTPDefaultErrorHandler):
     else:
       s = b''.join(fp).decode()
       resp = json.loads(s)
-    raise urllib.error.HTTPError(req.full_url, code, msg, hdrs, fp)
+    # Since the body has been consumed, provide it again to any callers which
+    # need to inspect it.
+    raise urllib.error.HTTPError(req.full_url, code, msg, hdrs, io.BytesIO(s.encode()))
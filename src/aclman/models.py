@@ -1,12 +1,28 @@
 import functools
 import datetime
 import calendar
+import io
 import xml.etree.ElementTree as ET
-import xml.dom.minidom
 
 @functools.total_ordering
 class Semester:
-  def __init__(self, semester):
+  __slots__ = ('semester', 'sem_type', 'year_code', 'semester_normalized', 'year', 'start', 'end')
+  # Semesters are interned by their (raw) semester code, so that each is only
+  # calculated once.
+  instances = {}
+  # Key dates for each year, as calculated by `__calendar()`.
+  calendar_table = {}
+
+  def __new__(cls, semester):
+    try:
+      return cls.instances[semester]
+    except KeyError:
+      pass
+    self = super().__new__(cls)
+    self.__calculate(semester)
+    return cls.instances.setdefault(semester, self)
+
+  def __calculate(self, semester):
     self.semester = semester
     self.sem_type = self.semester[0]
     if self.sem_type in ['M', 'N', 'U']:
@@ -15,8 +31,13 @@ class Semester:
     # Create a normalized semester code:
     self.semester_normalized = "%s%s" % (self.sem_type, self.year_code)
 
-    # Coerce two-digit year from semester code to a full, four-digit year.
-    self.year = datetime.datetime.strptime(self.year_code, '%y').year
+    # Coerce two-digit year from semester code to a full, four-digit year, as
+    # `strptime()` would for '%y'.
+    if len(self.year_code) != 2 or not self.year_code.isdigit():
+      raise ValueError("Invalid year for '%s'" % semester)
+    year = int(self.year_code)
+    self.year = 2000 + year if year <= 68 else 1900 + year
+    (mlk_day, commencement, fall_first_sunday) = self.__calendar(self.year)
 
     # SPRING TERM - hinges on end date
     # Typically ends on the Tuesday which is 5 days prior to Commencement.
@@ -24,14 +45,14 @@ class Semester:
     # - S21 is a special case (see below).
     # - From S22, term starts on the Monday which is 113 days earlier (14-week term plus Spring Break).
     if self.sem_type == 'S':
-      end_date = self.__commencement() - datetime.timedelta(days=5)
+      end_date = commencement - datetime.timedelta(days=5)
       if self.year <= 2020:
         start_date = end_date - datetime.timedelta(days=120)
       else:
         start_date = end_date - datetime.timedelta(days=113)
       # Sometimes this calculation causes the start date to fall on MLK Day, in
       # which case classes actually begin the following day.
-      if start_date == self.__mlk_day():
+      if start_date == mlk_day:
         start_date += datetime.timedelta(days=1)
     # SUMMER TERM - hinges on start date
     # Typically starts on the Monday which is 1 day after Commencement.
@@ -39,7 +60,7 @@ class Semester:
     # - U21 and U22 are special cases (see below).
     # - From U23, term ends on the Friday which is 88 days later (12-week term plus Summer Break).
     elif self.sem_type == 'U':
-      start_date = self.__commencement() + datetime.timedelta(days=1)
+      start_date = commencement + datetime.timedelta(days=1)
       if self.year <= 2021:
         end_date = start_date + datetime.timedelta(days=81)
       else:
@@ -50,7 +71,7 @@ class Semester:
     # - F21 is a special case (see below).
     # - From F22, term ends on the Monday which is 112 days later (14-week term plus Fall Break).
     elif self.sem_type == 'F':
-      first_sun = self.__first_sunday_of_month(self.year, 8)
+      first_sun = fall_first_sunday
       if first_sun <= 2:
         start_date = datetime.date(self.year, 8, first_sun + 29)
       else:
@@ -100,7 +121,7 @@ class Semester:
       prev_sem = "U%2d" % int(self.year_code)
     # If it's an unknown semester type, something is wrong.
     else:
-      raise ValueError("Unknown semester type for '%s'" % semester)
+      raise ValueError("Unknown semester type for '%s'" % self.semester)
 
     return Semester(prev_sem)
 
@@ -115,7 +136,7 @@ class Semester:
       next_sem = "S%2d" % ( int(self.year_code) + 1 % 100 )
     # If it's an unknown semester type, something is wrong.
     else:
-      raise ValueError("Unknown semester type for '%s'" % semester)
+      raise ValueError("Unknown semester type for '%s'" % self.semester)
 
     return Semester(next_sem)
 
@@ -131,29 +152,45 @@ class Semester:
   def __hash__(self):
     return hash(self.semester)
 
-  def __first_sunday_of_month(self, year, month):
-    return calendar.monthcalendar(year, month)[0][calendar.SUNDAY]
+  @staticmethod
+  def __first_sunday_of_month(year, month):
+    return 1 + (calendar.SUNDAY - datetime.date(year, month, 1).weekday()) % 7
 
-  # MLK Day for this year
-  def __mlk_day(self):
-    first_sun = self.__first_sunday_of_month(self.year, 1)
+  # MLK Day for a year
+  @staticmethod
+  def __mlk_day(year):
+    first_sun = Semester.__first_sunday_of_month(year, 1)
     # The third Monday in January.
     if first_sun == 7:
-      return datetime.date(self.year, 1, first_sun + 8)
+      return datetime.date(year, 1, first_sun + 8)
     else:
-      return datetime.date(self.year, 1, first_sun + 15)
-  # Commencement date for this year
-  def __commencement(self):
-    first_sun = self.__first_sunday_of_month(self.year, 5)
+      return datetime.date(year, 1, first_sun + 15)
+  # Commencement date for a year
+  @staticmethod
+  def __commencement(year):
+    first_sun = Semester.__first_sunday_of_month(year, 5)
     # Beginning 2023, the second Sunday in May.
-    if self.year >= 2023:
-      return datetime.date(self.year, 5, first_sun + 7)
+    if year >= 2023:
+      return datetime.date(year, 5, first_sun + 7)
     # Through 2022, the third Sunday in May.
     else:
-      return datetime.date(self.year, 5, first_sun + 14)
+      return datetime.date(year, 5, first_sun + 14)
+
+  # Key dates for a year, calculated once: MLK Day, Commencement, and the
+  # first Sunday in August.
+  @classmethod
+  def __calendar(cls, year):
+    try:
+      return cls.calendar_table[year]
+    except KeyError:
+      pass
+    dates = (Semester.__mlk_day(year), Semester.__commencement(year), Semester.__first_sunday_of_month(year, 8))
+    return cls.calendar_table.setdefault(year, dates)
 
 @functools.total_ordering
 class Purpose:
+  __slots__ = ()
+
   def __eq__(self, other):
     return self.purpose_sort_order() == other.purpose_sort_order()
 
@@ -163,7 +200,17 @@ class Purpose:
 
 @functools.total_ordering
 class Section(Purpose):
-  def __init__(self, semester, course, section):
+  __slots__ = ('semester', 'course', 'section')
+  # Sections are interned, so that equal sections share a single instance.
+  instances = {}
+
+  def __new__(cls, semester, course, section):
+    key = (str(semester), course, section)
+    try:
+      return cls.instances[key]
+    except KeyError:
+      pass
+    self = super().__new__(cls)
     # Convert semester to a Semester object if it is passed, e.g., as a string.
     if isinstance(semester, Semester):
       self.semester = semester
@@ -171,6 +218,7 @@ class Section(Purpose):
       self.semester = Semester(semester)
     self.course = course
     self.section = section
+    return cls.instances.setdefault(key, self)
 
   def __str__(self):
     return "%s-%s-%s" % (self.semester, self.course, self.section)
@@ -185,9 +233,19 @@ class Section(Purpose):
 
 
 class PrivilegeType:
-  def __init__(self, key, value):
+  __slots__ = ('key', 'value')
+  # Privilege types are interned, so that equal types share a single instance.
+  instances = {}
+
+  def __new__(cls, key, value):
+    try:
+      return cls.instances[(key, value)]
+    except KeyError:
+      pass
+    self = super().__new__(cls)
     self.key = key
     self.value = value
+    return cls.instances.setdefault((key, value), self)
 
   def __str__(self):
     return "(%s,%s)" % (self.key, self.value)
@@ -203,23 +261,50 @@ class PrivilegeType:
 
 
 class Privilege:
+  __slots__ = ('privilege_type', 'key', 'value', 'start', 'actual_start', 'end', 'actual_end', 'sections')
+  # Open-ended privileges are bounded 25 years either side of now.
+  open_start = datetime.datetime(datetime.date.today().year - 25, 1, 1, 0, 0, 0)
+  open_end = datetime.datetime(datetime.date.today().year + 25, 12, 31, 23, 59, 59)
+
   def __init__(self, privilege_type, start, end, sections):
-    t = datetime.datetime.now()
-    self.privilege_type = privilege_type
-    self.key = self.privilege_type.key
-    self.value = self.privilege_type.value
+    # Start and end are given as strings, e.g., "2023-01-17 00:00:00", or as
+    # empty or "None" if open-ended.
     if start and start != "None":
-      self.start = datetime.datetime.strptime(start, "%Y-%m-%d %H:%M:%S")
-      self.actual_start = self.start
+      start = self.__parse(start)
     else:
-      self.start = datetime.datetime(t.year - 25, 1, 1, 0, 0, 0)
-      self.actual_start = None
+      start = None
     if end and end != "None":
-      self.end = datetime.datetime.strptime(end, "%Y-%m-%d %H:%M:%S")
-      self.actual_end = self.end
+      end = self.__parse(end)
     else:
-      self.end = datetime.datetime(t.year + 25, 12, 31, 23, 59, 59)
-      self.actual_end = None
+      end = None
+    self.__set(privilege_type, start, end, sections)
+
+  @staticmethod
+  def __parse(s):
+    # Parse a (naive) datetime in exactly the format "%Y-%m-%d %H:%M:%S", as
+    # `strptime()` would, but much faster.  Checking the positions of the
+    # separators first rules out any other format `fromisoformat()` accepts,
+    # e.g., dates alone or times with time zones.
+    if len(s) != 19 or s[4] != '-' or s[7] != '-' or s[10] != ' ' or s[13] != ':' or s[16] != ':':
+      raise ValueError("time data %r does not match format '%%Y-%%m-%%d %%H:%%M:%%S'" % s)
+    return datetime.datetime.fromisoformat(s)
+
+  @classmethod
+  def from_datetimes(cls, privilege_type, start, end, sections):
+    # Construct a privilege from datetimes, or None if open-ended, rather than
+    # from strings.
+    self = cls.__new__(cls)
+    self.__set(privilege_type, start, end, sections)
+    return self
+
+  def __set(self, privilege_type, start, end, sections):
+    self.privilege_type = privilege_type
+    self.key = privilege_type.key
+    self.value = privilege_type.value
+    self.actual_start = start
+    self.start = self.open_start if start is None else start
+    self.actual_end = end
+    self.end = self.open_end if end is None else end
     self.sections = sections
 
   def __str__(self):
@@ -235,8 +320,11 @@ class Privilege:
   def __lt__(self, other):
     return (self.privilege_type, self.start, self.end, self.sections) < (other.privilege_type, other.start, other.end, other.sections)
 
+  def __hash__(self):
+    return hash((self.privilege_type, self.start, self.end, tuple(self.sections)))
+
   def replace_sections(self, sections):
-    return Privilege(self.privilege_type, str(self.start), str(self.end), sections)
+    return Privilege.from_datetimes(self.privilege_type, self.start, self.end, sections)
 
   def is_current(self, t=None):
     if t == None:
@@ -262,10 +350,10 @@ class Privilege:
     sections = a.sections + b.sections
     # If they're considered equal, just combine the sections:
     if a == b:
-      return Privilege(a.privilege_type, str(a.start), str(a.end), sections)
+      return Privilege.from_datetimes(a.privilege_type, a.start, a.end, sections)
     # If periods overlap (or are 1 second apart), simply combine them:
     if b.start <= a.end + datetime.timedelta(seconds=1):
-      return Privilege(a.privilege_type, str(min(a.start, b.start)), str(max(a.end, b.end)), sections)
+      return Privilege.from_datetimes(a.privilege_type, min(a.start, b.start), max(a.end, b.end), sections)
     # If no overlap, prefer the one that is current:
     if a.is_current():
       return a
@@ -280,6 +368,53 @@ class Privilege:
     # Otherwise, prefer the one least in the past:
     return b
 
+  @staticmethod
+  def coalesce_all(privileges, t=None):
+    # Coalesce any number of privileges of the same type into one, with a
+    # single sweep over them in order of start time: overlapping periods (or
+    # those 1 second apart) are merged, combining their sections.  Of the
+    # resulting disjoint periods, prefer the one that is current; otherwise,
+    # the next one in the future; otherwise, the one least in the past.
+    # Privileges are ordered fully (i.e., by sections too), so the result,
+    # including the order of its sections, doesn't depend on their order.
+    privileges = sorted(privileges, key=lambda x: (x.start, x.end, x.sections))
+    if len(privileges) == 0:
+      raise ValueError("Cannot coalesce an empty list of privileges")
+    privilege_type = privileges[0].privilege_type
+    if any(x.privilege_type != privilege_type for x in privileges):
+      raise ValueError("Cannot coalesce privileges %s since they are not of the same type" % ','.join(str(x) for x in privileges))
+    if t is None:
+      t = datetime.datetime.now()
+
+    # Each merged period is a list of its start, its end, and its privileges.
+    periods = []
+    for privilege in privileges:
+      if periods and privilege.start <= periods[-1][1] + datetime.timedelta(seconds=1):
+        period = periods[-1]
+        period[1] = max(period[1], privilege.end)
+        period[2].append(privilege)
+      else:
+        periods.append([privilege.start, privilege.end, [privilege]])
+
+    selected = None
+    for period in periods:
+      if period[0] <= t <= period[1]:
+        selected = period
+        break
+      if period[0] > t:
+        # This is the earliest period in the future; if none is current, the
+        # latest in the past comes before it.
+        selected = period
+        break
+    if selected is None:
+      selected = periods[-1]
+
+    (start, end, merged) = selected
+    if len(merged) == 1:
+      return merged[0]
+    sections = [ section for privilege in merged for section in privilege.sections ]
+    return Privilege.from_datetimes(privilege_type, start, end, sections)
+
 
 class Student:
   def __init__(self, data):
@@ -309,26 +444,61 @@ class Student:
     return "%-8s - %s" % (self.andrewId, self.allNames)
 
 
+# Escape text for CSGold XML files, exactly as `xml.dom.minidom` would.
+def _xml_escape(text):
+  return text.replace("&", "&amp;").replace("<", "&lt;").replace("\"", "&quot;").replace(">", "&gt;")
+
 class CsGoldData:
-  def __init__(self, comment):
-    self.xml = ET.Element('AccessAssignments')
-    self.xml.append(ET.Comment(comment))
+  # Access assignments are written out as they are appended, either straight
+  # to the file at `path`, if given, or otherwise to an in-memory buffer for
+  # `export_xml()`, so that memory use doesn't grow with the number of
+  # assignments when streaming.  The output is pretty-printed with two-space
+  # indents, matching what `xml.dom.minidom` produces.
+  def __init__(self, comment, path=None):
+    if path is None:
+      self.xmlfile = io.StringIO()
+    else:
+      self.xmlfile = open(path, 'w')
+    self.count = 0
+    self.closed = False
+    self.xmlfile.write('<?xml version="1.0" ?>\n<AccessAssignments>\n  <!--%s-->\n' % comment)
+
+  def __len__(self):
+    return self.count
+
+  # Read the access assignments from a previously exported file, as a
+  # dictionary mapping each (AndrewID, GroupNumber) to its (StartDate,
+  # EndDate).
+  @staticmethod
+  def load_access_assignments(path):
+    assignments = {}
+    for event, priv_asgn in ET.iterparse(path):
+      if priv_asgn.tag != 'AccessAssignment':
+        continue
+      key = (priv_asgn.findtext('AndrewID'), priv_asgn.findtext('GroupNumber'))
+      assignments[key] = (priv_asgn.findtext('StartDate'), priv_asgn.findtext('EndDate'))
+      priv_asgn.clear()
+    return assignments
 
   def append_access_assignment(self, andrewId, groupId, start_date, end_date, comment):
-    priv_asgn = ET.SubElement(self.xml, 'AccessAssignment')
-
-    priv_asgn_andrewid = ET.SubElement(priv_asgn, 'AndrewID')
-    priv_asgn_group = ET.SubElement(priv_asgn, 'GroupNumber')
-    priv_asgn_start = ET.SubElement(priv_asgn, 'StartDate')
-    priv_asgn_end = ET.SubElement(priv_asgn, 'EndDate')
-    priv_asgn_comment = ET.SubElement(priv_asgn, 'Comment')
+    self.count += 1
+    fields = [('AndrewID', andrewId), ('GroupNumber', groupId), ('StartDate', start_date), ('EndDate', end_date), ('Comment', comment)]
+    lines = ['  <AccessAssignment>\n']
+    for tag, text in fields:
+      if text:
+        lines.append('    <%s>%s</%s>\n' % (tag, _xml_escape(text), tag))
+      else:
+        lines.append('    <%s/>\n' % tag)
+    lines.append('  </AccessAssignment>\n')
+    self.xmlfile.write(''.join(lines))
 
-    priv_asgn_andrewid.text = andrewId
-    priv_asgn_group.text = groupId
-    priv_asgn_start.text = start_date
-    priv_asgn_end.text = end_date
-    priv_asgn_comment.text = comment
+  def close(self):
+    if not self.closed:
+      self.xmlfile.write('</AccessAssignments>\n')
+      self.closed = True
+      if not isinstance(self.xmlfile, io.StringIO):
+        self.xmlfile.close()
 
   def export_xml(self):
-    xmldata = xml.dom.minidom.parseString(ET.tostring(self.xml))
-    return xmldata.toprettyxml(indent="  ")
+    self.close()
+    return self.xmlfile.getvalue()
@@ -0,0 +1,68 @@
+import csv
+import importlib.resources
+import logging
+import pathlib
+
+from .models import *
+from . import config_handler
+
+logger = logging.getLogger(__name__)
+
+
+# A section file is a CSV file defining the privileges conferred by enrollment
+# in each section, with one privilege per row:
+#   semester,course,section,privilege key,privilege value,start,end
+# e.g., `F23,60210,A,base,1,2023-08-28 00:00:00,None`.
+
+
+def open_section_file(path=None):
+  # Open the section file at `path`, relative to the invocation directory, or
+  # the built-in one if no path is given.
+  if path is None:
+    default_section_file_input = config_handler.get_config('default_inputs.section_file')
+    return importlib.resources.open_text(default_section_file_input['package'], default_section_file_input['file'])
+
+  section_file_path = pathlib.Path(config_handler.cwd, path).resolve()
+  if not section_file_path.is_file():
+    raise FileNotFoundError("No section file found at '%s'" % section_file_path)
+  return open(section_file_path, "r")
+
+def load(path=None):
+  # Read the section file at `path` (or the built-in one) in a single pass,
+  # and return a tuple of:
+  # - the sections, as a dictionary used as an ordered set;
+  # - the privilege types, likewise; and
+  # - a dictionary mapping each section to its privileges, likewise.
+  # Duplicate sections and privileges are skipped.
+  sections = {}
+  privilege_types = {}
+  section_privileges = {}
+  with open_section_file(path) as s:
+    for row in csv.reader(s):
+      # TODO: Be more robust in how this file is read in.
+      # TODO: Allow for comments/header in the section file.
+      section = Section(row[0], row[1], row[2])
+      privilege_type = PrivilegeType(row[3], row[4])
+      privilege = Privilege(privilege_type, row[5], row[6], [section])
+
+      # First, register the section if it's new.
+      if section not in sections:
+        # TODO: Verify that the section actually exists by calling
+        # `/course/courses?semester=...&courseNumber=...&section=...`
+        # NOTE: For now, we catch this later when we try to look up its
+        # crosslists.
+        sections[section] = None
+        section_privileges[section] = {}
+        logger.debug("Added section %s" % section)
+      # Then, register the privilege type if it's new.
+      if privilege_type not in privilege_types:
+        logger.debug("Identified new privilege type %s" % privilege_type)
+        privilege_types[privilege_type] = None
+      # Finally, register the specific privilege.
+      if privilege in section_privileges[section]:
+        logger.debug("Skipped duplicate privilege for %s: %s" % (section, privilege))
+      else:
+        section_privileges[section][privilege] = None
+        logger.debug("Added privilege for %s: %s" % (section, privilege))
+
+  return (sections, privilege_types, section_privileges)
@@ -7,9 +7,10 @@ import urllib.parse
 from .. import config_handler
 from .. import helpers
 from ..api import zoho as Zoho
+from ..api import transport
 
-instrumented_opener = urllib.request.build_opener(helpers.CustomHTTPErrorHandler)
-urllib.request.install_opener(instrumented_opener)
+instrumented_opener = transport.build_opener(helpers.CustomHTTPErrorHandler)
+transport.install_opener(instrumented_opener)
 
 secrets = config_handler.get_secrets('zoho_api')
 
@@ -71,7 +72,7 @@ print("    Requesting refresh token...")
 endpoint = "%s/oauth/v2/token?client_id=%s&client_secret=%s&code=%s&grant_type=authorization_code" % (base_accounts_url, secrets['client_id'], secrets['client_secret'], authorization_code)
 try:
   req = urllib.request.Request(endpoint, data=None, method='POST')
-  resp = urllib.request.urlopen(req).read()
+  resp = transport.urlopen(req).read()
   resp_data = json.loads(resp.decode('utf-8'))
   if 'error' in resp_data:
     print('''
@@ -0,0 +1,141 @@
+import datetime
+import json
+import pathlib
+import sqlite3
+
+from . import helpers
+
+
+# Snapshots are the JSON files of calculated per-user data written by each
+# run, e.g., `output/jsondata/latest.json`.  Each may be accompanied by an
+# index, e.g., `output/jsondata/latest.sqlite`, holding the same data keyed by
+# Andrew ID, so that a single user can be looked up without parsing the whole
+# snapshot.
+
+def load(path):
+  # Return the snapshot at `path`, or None if there is none.
+  try:
+    with open(path, 'r') as jsonfile:
+      return json.load(jsonfile)
+  except FileNotFoundError:
+    return None
+
+def write(path, timestamp, users, index_path=None):
+  # Write a snapshot to `path`, given its `timestamp` and an iterable of
+  # (Andrew ID, data) pairs for its users, sorted by Andrew ID.  Users are
+  # serialized one at a time, so memory use doesn't grow with the number of
+  # users, but the file is identical to that which would be written by
+  # `json.dumps(..., sort_keys=True, indent=2, cls=helpers.CustomJSONEncoder)`
+  # for the whole snapshot.  If `index_path` is given, also write an index of
+  # the snapshot there.
+  encoder = helpers.CustomJSONEncoder(sort_keys=True, indent=2)
+  index = None
+  if index_path is not None:
+    index_encoder = helpers.CustomJSONEncoder(sort_keys=True)
+    index = sqlite3.connect(str(index_path))
+    index.execute("DROP TABLE IF EXISTS snapshot")
+    index.execute("DROP TABLE IF EXISTS users")
+    index.execute("CREATE TABLE snapshot (timestamp TEXT NOT NULL)")
+    index.execute("CREATE TABLE users (andrewId TEXT PRIMARY KEY, data TEXT NOT NULL)")
+    index.execute("INSERT INTO snapshot (timestamp) VALUES (?)", (timestamp,))
+  with open(path, 'w') as jsonfile:
+    jsonfile.write('{\n  "timestamp": %s,\n  "users": {' % encoder.encode(timestamp))
+    separator = '\n'
+    for andrewId, data in users:
+      jsonfile.write('%s    %s: ' % (separator, encoder.encode(andrewId)))
+      # Indent each user's data to its depth within the snapshot.  Newlines
+      # within strings are always escaped, so every newline is indentation.
+      for chunk in encoder.iterencode(data):
+        jsonfile.write(chunk.replace('\n', '\n    '))
+      separator = ',\n'
+      if index is not None:
+        index.execute("INSERT INTO users (andrewId, data) VALUES (?, ?)", (andrewId, index_encoder.encode(data)))
+    if separator == '\n':
+      jsonfile.write('}\n}')
+    else:
+      jsonfile.write('\n  }\n}')
+  if index is not None:
+    index.commit()
+    index.close()
+
+def lookup_user(path, index_path, andrewId):
+  # Return a tuple of the timestamp of the snapshot at `path` and the data for
+  # a single user from it, raising a KeyError if there is no such user.  The
+  # snapshot's index at `index_path` is used if it exists; otherwise, the whole
+  # snapshot must be read.
+  index_path = pathlib.Path(index_path).resolve()
+  if not index_path.is_file():
+    with open(path, 'r') as jsonfile:
+      jsondata = json.load(jsonfile)
+    return (jsondata['timestamp'], jsondata['users'][andrewId])
+
+  index = sqlite3.connect("%s?mode=ro" % index_path.as_uri(), uri=True)
+  try:
+    (timestamp,) = index.execute("SELECT timestamp FROM snapshot").fetchone()
+    row = index.execute("SELECT data FROM users WHERE andrewId = ?", (andrewId,)).fetchone()
+  finally:
+    index.close()
+  if row is None:
+    raise KeyError(andrewId)
+  return (timestamp, json.loads(row[0]))
+
+def get_changed_users(previous, current, t=None):
+  # Compare the users in a `previous` snapshot against the `current`
+  # calculated state, given as a dictionary mapping each Andrew ID to a tuple
+  # of its billable flag and its list of coalesced privileges, and return the
+  # set of Andrew IDs whose effective state has changed.  This includes users
+  # who have been added or dropped, whose billable flag or privileges differ,
+  # and whose privileges have started or ended in the meantime.
+  if t is None:
+    t = datetime.datetime.now()
+  since = datetime.datetime.fromisoformat(previous['timestamp']).astimezone().replace(tzinfo=None)
+
+  previous_users = previous['users']
+  changed = set(previous_users).symmetric_difference(current)
+  for andrewId, (billable, privileges) in current.items():
+    if andrewId not in previous_users:
+      continue
+    previous_user = previous_users[andrewId]
+    if previous_user['academic']['billable'] != billable:
+      changed.add(andrewId)
+    elif previous_user['privileges'] != [ str(x) for x in privileges ]:
+      changed.add(andrewId)
+    elif any(since < x.start <= t or since <= x.end < t for x in privileges):
+      changed.add(andrewId)
+  return changed
+
+
+def read_full_sync_time(path):
+  # Return the time of the last full sync recorded at `path`, if any.
+  try:
+    with open(path, 'r') as timefile:
+      return datetime.datetime.fromisoformat(timefile.read().strip())
+  except (FileNotFoundError, ValueError):
+    return None
+
+def write_full_sync_time(path, t):
+  with open(path, 'w') as timefile:
+    timefile.write("%s\n" % t.isoformat())
+
+def clear_full_sync_time(path):
+  # Forget the last full sync, so that the next incremental run is a full one.
+  pathlib.Path(path).unlink(missing_ok=True)
+
+
+# Override groups grant access independently of the calculated state in
+# snapshots, so the memberships seen by each run are recorded separately,
+# e.g., at `output/jsondata/overrides.json`, as a dictionary mapping each
+# override group to a sorted list of its members.
+
+def read_overrides(path):
+  # Return the override group memberships recorded at `path`, or None if there
+  # are none.
+  try:
+    with open(path, 'r') as jsonfile:
+      return { group: set(members) for group, members in json.load(jsonfile).items() }
+  except (FileNotFoundError, ValueError):
+    return None
+
+def write_overrides(path, overrides):
+  with open(path, 'w') as jsonfile:
+    json.dump({ group: sorted(members) for group, members in overrides.items() }, jsonfile, sort_keys=True, indent=2)
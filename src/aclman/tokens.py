@@ -0,0 +1,81 @@
+import os
+import pathlib
+import threading
+import time
+import json
+
+from . import config_handler
+
+
+# A persistent store of API access tokens, e.g., Zoho OAuth access tokens and
+# BioRAFT JWTs, shared by every ACLMAN process invoked from the same directory.
+# Each token is kept with its expiry time and reused until shortly before it
+# expires, so short-lived invocations (e.g., `aclman.user_check`) needn't
+# authenticate at all, and long runs transparently get a fresh token whenever
+# one is about to expire.  The file is readable only by the user running
+# ACLMAN, since these tokens grant access just as the secrets which obtain
+# them do.
+
+# Tokens are refreshed once they are within this many seconds of expiring.
+expiry_margin = 300
+
+shared_store = None
+shared_store_lock = threading.Lock()
+
+
+class TokenStore:
+  def __init__(self, path):
+    self.path = pathlib.Path(path)
+    self.path.parent.mkdir(parents=True, exist_ok=True)
+    self.lock = threading.Lock()
+    self.tokens = None
+
+  def __load(self):
+    try:
+      with open(self.path, 'r') as tokenfile:
+        return json.load(tokenfile)
+    except (FileNotFoundError, ValueError):
+      return {}
+
+  def __save(self):
+    # Write a new file and move it into place, so that other processes never
+    # see a partially-written file.
+    tmp_path = self.path.with_name("%s.%d.tmp" % (self.path.name, os.getpid()))
+    fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, 'w') as tokenfile:
+      json.dump(self.tokens, tokenfile)
+    os.replace(tmp_path, self.path)
+
+  def __is_fresh(self, entry):
+    return entry is not None and entry['expires'] - expiry_margin > time.time()
+
+  def get_token(self, name, fetch):
+    # Return the stored token for `name` if it is still fresh; otherwise, call
+    # `fetch()` to get a new token and its lifetime in seconds, and store it.
+    with self.lock:
+      if self.tokens is None:
+        self.tokens = self.__load()
+      entry = self.tokens.get(name)
+      if not self.__is_fresh(entry):
+        # Another process may have since fetched a new token.
+        self.tokens = self.__load()
+        entry = self.tokens.get(name)
+      if not self.__is_fresh(entry):
+        (token, lifetime) = fetch()
+        entry = { 'token': token, 'expires': time.time() + lifetime }
+        self.tokens[name] = entry
+        self.__save()
+      return entry['token']
+
+
+def get_store():
+  global shared_store
+
+  with shared_store_lock:
+    if shared_store is None:
+      cache_dir = config_handler.get_config('output_dirs.cache')
+      shared_store = TokenStore(pathlib.Path(config_handler.cwd, cache_dir, 'tokens.json').resolve())
+  return shared_store
+
+def get_token(name, fetch):
+  return get_store().get_token(name, fetch)
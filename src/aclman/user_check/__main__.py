@@ -3,7 +3,9 @@
 import json
 
 from ..cli import CliParser
+from .. import cache
 from .. import helpers
+from ..api import s3 as S3
 
 from . import enrollment
 from . import laser_groups
@@ -14,8 +16,13 @@ cli = CliParser('ACLMAN user check', "python -m aclman.user_check")
 cli.option(metavar='ANDREWID', action='store', dest='andrewId', default=None, help="the Andrew ID of the user to check")
 cli.option('--attr', '--attribute', '-a', metavar='ATTR', action='store', dest='attribute', default=None, help="specify a subtree of the user's data to return")
 cli.option('--no-pretty', action='store_false', dest='pretty', default=True, help="don't pretty-print the JSON output")
+cli.option('--refresh', action='store_true', dest='refresh', default=False, help="ignore all cached API data (from S3 and BioRAFT) and refetch it, updating the cache")
 args = cli.parse()
 
+cache.refresh = args.refresh
+# Academic data needn't be as current here as for the main run.
+S3.academic_ttl = 's3_academic_user_check'
+
 
 andrewId = args.andrewId
 user_data = {}
@@ -1,22 +1,19 @@
 import pathlib
-import json
 
 from .. import config_handler
 from .. import helpers
+from .. import snapshot
 from ..api import s3 as S3
 
 
 jsondata_dir = config_handler.get_config('output_dirs.jsondata')
 jsondata_path = pathlib.Path(config_handler.cwd, jsondata_dir, 'latest.json').resolve()
+jsondata_index_path = pathlib.Path(config_handler.cwd, jsondata_dir, 'latest.sqlite')
 
 
 def get_user(andrewId):
   try:
-    with open(jsondata_path, 'r') as jsonfile:
-      jsondata = json.load(jsonfile)
-
-    cached_data = jsondata['users'][andrewId]
-    timestamp = jsondata['timestamp']
+    (timestamp, cached_data) = snapshot.lookup_user(jsondata_path, jsondata_index_path, andrewId)
 
     enrollment_data = {
       'timestamp': timestamp,
@@ -10,8 +10,9 @@ def get_user(andrewId):
   group_data = {'timestamp': helpers.now().isoformat(),
                 'eligibility_groups': {}
                }
+  memberships = Grouper.get_memberships(andrewId, group_mappings.values())
   for group in group_mappings:
     group_id = group_mappings[group]
-    group_data['eligibility_groups'][group] = Grouper.has_member(group_id, andrewId)
+    group_data['eligibility_groups'][group] = ( group_id in memberships )
   return group_data
 
@@ -0,0 +1,153 @@
+import datetime
+import itertools
+import json
+import random
+
+import pytest
+
+from aclman import helpers
+from aclman import snapshot
+from aclman.models import *
+
+
+now = datetime.datetime.now().replace(microsecond=0)
+day = datetime.timedelta(days=1)
+base = PrivilegeType('base', '1')
+sections = [ Section('F23', '60210', x) for x in 'ABCDE' ]
+
+def privilege(start, end, section=sections[0], privilege_type=base):
+  # A privilege from `start` to `end` days from now.
+  return Privilege.from_datetimes(privilege_type, now + start * day, now + end * day, [section])
+
+def pairwise(privileges):
+  # Coalesce privileges as was done before `Privilege.coalesce_all()`.
+  privileges = list(privileges)
+  while len(privileges) > 1:
+    a = privileges.pop()
+    b = privileges.pop()
+    privileges.append(a.coalesce(b))
+  return privileges[0]
+
+
+# Coalescing
+
+def test_coalesce_all_merges_overlapping_periods():
+  p = Privilege.coalesce_all([ privilege(-10, 0, sections[1]), privilege(-5, 5, sections[0]) ])
+  assert (p.start, p.end) == (now - 10 * day, now + 5 * day)
+  assert p.sections == [ sections[1], sections[0] ]
+
+def test_coalesce_all_merges_periods_one_second_apart():
+  a = Privilege.from_datetimes(base, now - day, now, [sections[0]])
+  b = Privilege.from_datetimes(base, now + datetime.timedelta(seconds=1), now + day, [sections[1]])
+  p = Privilege.coalesce_all([ a, b ])
+  assert (p.start, p.end) == (now - day, now + day)
+
+def test_coalesce_all_merges_across_a_bridging_period():
+  p = Privilege.coalesce_all([ privilege(-20, -10), privilege(10, 20), privilege(-10, 10) ])
+  assert (p.start, p.end) == (now - 20 * day, now + 20 * day)
+
+@pytest.mark.parametrize('periods, expected', [
+  # Prefer the current period, then the next one in the future, then the one
+  # least in the past.
+  ([ (-20, -10), (-1, 1), (10, 20) ], (-1, 1)),
+  ([ (-20, -10), (10, 20), (30, 40) ], (10, 20)),
+  ([ (-40, -30), (-20, -10) ], (-20, -10)),
+])
+def test_coalesce_all_prefers_current_then_future_then_recent(periods, expected):
+  p = Privilege.coalesce_all([ privilege(*x) for x in periods ], now)
+  assert (p.start, p.end) == (now + expected[0] * day, now + expected[1] * day)
+
+def test_coalesce_all_rejects_unlike_or_no_privileges():
+  with pytest.raises(ValueError):
+    Privilege.coalesce_all([ privilege(0, 1), privilege(0, 1, privilege_type=PrivilegeType('3dprint', '1')) ])
+  with pytest.raises(ValueError):
+    Privilege.coalesce_all([])
+
+def test_coalesce_all_matches_pairwise_coalescing():
+  # The result never depends on the order of the privileges, and matches the
+  # former pairwise coalescing whenever that didn't depend on their order
+  # either, including the order of the resulting sections.
+  rng = random.Random(0)
+  for _ in range(500):
+    privileges = []
+    for _ in range(rng.randint(2, 4)):
+      start = rng.randint(-60, 60)
+      privileges.append(privilege(start, start + rng.randint(0, 40), rng.choice(sections)))
+    if rng.random() < 0.3:
+      privileges[1] = Privilege.from_datetimes(base, privileges[0].start, privileges[0].end, [rng.choice(sections)])
+    # NOTE: Pairwise coalescing always compares against the current time.
+    results = { str(Privilege.coalesce_all(list(x))) for x in itertools.permutations(privileges) }
+    assert len(results) == 1
+    pairwise_results = { str(pairwise(x)) for x in itertools.permutations(privileges) }
+    if len(privileges) == 2 or len(pairwise_results) == 1:
+      assert results == pairwise_results
+
+
+# Snapshots
+
+def user_data(andrewId, billable, privileges):
+  return {
+    'academic': { 'billable': billable },
+    'biographical': { 'andrewId': andrewId },
+    'privileges': privileges,
+    'sections': [ x for p in privileges for x in p.sections ]
+  }
+
+def test_snapshot_write_matches_json_dumps(tmp_path):
+  users = [ ('alice', user_data('alice', True, [ privilege(-1, 1) ])), ('bob', user_data('bob', False, [])) ]
+  timestamp = helpers.now().isoformat()
+  snapshot.write(tmp_path / 'data.json', timestamp, iter(users))
+  expected = json.dumps({ 'timestamp': timestamp, 'users': dict(users) }, sort_keys=True, indent=2, cls=helpers.CustomJSONEncoder)
+  assert (tmp_path / 'data.json').read_text() == expected
+
+def test_snapshot_write_with_no_users(tmp_path):
+  snapshot.write(tmp_path / 'data.json', 'now', iter([]))
+  assert snapshot.load(tmp_path / 'data.json') == { 'timestamp': 'now', 'users': {} }
+
+def test_snapshot_lookup_with_and_without_index(tmp_path):
+  users = [ ('alice', user_data('alice', True, [ privilege(-1, 1) ])), ('bob', user_data('bob', False, [])) ]
+  timestamp = helpers.now().isoformat()
+  snapshot.write(tmp_path / 'data.json', timestamp, iter(users), tmp_path / 'data.sqlite')
+  loaded = snapshot.load(tmp_path / 'data.json')
+  for index_path in [ tmp_path / 'data.sqlite', tmp_path / 'missing.sqlite' ]:
+    assert snapshot.lookup_user(tmp_path / 'data.json', index_path, 'alice') == (timestamp, loaded['users']['alice'])
+    with pytest.raises(KeyError):
+      snapshot.lookup_user(tmp_path / 'data.json', index_path, 'carol')
+
+def test_snapshot_load_missing(tmp_path):
+  assert snapshot.load(tmp_path / 'missing.json') is None
+
+
+# Changed-user detection
+
+@pytest.fixture
+def previous(tmp_path):
+  # A snapshot from two days ago, and the current state of its users.
+  privileges = {
+    'alice': [ privilege(-10, 10) ],
+    'bob': [ privilege(-10, 10) ],
+    'carol': [ privilege(5, 10) ],
+    'dave': [ privilege(-10, -1) ],
+  }
+  users = ( (andrewId, user_data(andrewId, True, x)) for andrewId, x in sorted(privileges.items()) )
+  snapshot.write(tmp_path / 'data.json', (now - 2 * day).astimezone().isoformat(), users)
+  current = { andrewId: (True, x) for andrewId, x in privileges.items() }
+  return (snapshot.load(tmp_path / 'data.json'), current)
+
+def test_get_changed_users_unchanged(previous):
+  (previous, current) = previous
+  assert snapshot.get_changed_users(previous, current, now - day) == set()
+
+def test_get_changed_users_detects_changes(previous):
+  (previous, current) = previous
+  current['alice'] = (False, current['alice'][1])
+  current['bob'] = (True, [ privilege(-10, 20) ])
+  del current['carol']
+  current['erin'] = (True, [ privilege(-10, 10) ])
+  assert snapshot.get_changed_users(previous, current, now - day) == { 'alice', 'bob', 'carol', 'erin' }
+
+def test_get_changed_users_detects_starts_and_ends_since(previous):
+  # Dave's privilege ends a day ago, and Carol's starts in five days.
+  (previous, current) = previous
+  assert snapshot.get_changed_users(previous, current, now) == { 'dave' }
+  assert snapshot.get_changed_users(previous, current, now + 6 * day) == { 'carol', 'dave' }